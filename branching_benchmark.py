@@ -0,0 +1,45 @@
+from btree import Btree
+from time import perf_counter
+import random
+
+'''
+Benchmark the branching factor of the Btree
+
+A tree with N random keys is bulk loaded for every b, and we time random point lookups (find with "==")
+and range scans (find with ">=") that return about SCAN rows.
+Small nodes make the tree tall, large ones make every node more expensive to search (and to update).
+'''
+
+N = 10**6
+LOOKUPS = 10000
+SCANS = 200
+SCAN = 1000
+BS = [3, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+random.seed(0)
+keys = random.sample(range(N*10), N)
+ordered = sorted(keys)
+probes = random.choices(keys, k=LOOKUPS)
+# the scans start SCAN keys before the end, so each returns SCAN ptrs
+scan_starts = [ordered[-SCAN] for _ in range(SCANS)]
+
+print(f'{"b":>6}  {"nodes":>8}  {"build (s)":>10}  {"us/lookup":>10}  {"ms/scan":>8}')
+
+for b in BS:
+    start = perf_counter()
+    bt = Btree(b)
+    bt.bulk_load((key, ptr) for ptr, key in enumerate(keys))
+    build = perf_counter() - start
+
+    start = perf_counter()
+    for key in probes:
+        bt.find('==', key, return_ops=True)
+    lookup = perf_counter() - start
+
+    start = perf_counter()
+    for key in scan_starts:
+        bt.find('>=', key, return_ops=True)
+    scan = perf_counter() - start
+
+    print(f'{b:>6}  {len(bt.nodes):>8}  {build:>10.2f}  {lookup/LOOKUPS*1e6:>10.2f}  {scan/SCANS*1e3:>8.3f}')
+    del bt
@@ -3,6 +3,8 @@ https://en.wikipedia.org/wiki/B%2B_tree
 """
 
 import math
+from bisect import bisect_left, bisect_right
+from itertools import groupby
 
 class Node:
     """
@@ -31,24 +33,18 @@ class Node:
         value: the value that we are searching for
         return_ops: set to True if you want to use the number of operations (for benchmarking)
         """
-        ops = 0  # number of operations (<>= etc). Used for benchmarking
         if self.is_leaf:  #
             return
 
-        # for each value in the node, if the user supplied value is smaller, return the btrees value index
-        # else (no value in the node is larger) return the last ptr
-        for index, existing_val in enumerate(self.values):
-            ops += 1
-            if value < existing_val:
-                if return_ops:
-                    return self.ptrs[index], ops
-                else:
-                    return self.ptrs[index]
-
+        # binary search for the first value in the node that is larger than the user supplied value, and return
+        # the ptr in the same position. If no value in the node is larger, this is the last ptr.
+        index = bisect_right(self.values, value)
         if return_ops:
-            return self.ptrs[-1], ops
+            # number of operations (<>= etc) of the binary search. Used for benchmarking
+            ops = math.ceil(math.log2(len(self.values)+1))
+            return self.ptrs[index], ops
         else:
-            return self.ptrs[-1]
+            return self.ptrs[index]
 
     def insert(self, value, ptr, ptr1=None):
         """
@@ -60,20 +56,22 @@ class Node:
         ptr1: the 2nd ptr (in case the user wants to insert into a nonleaf node for ex)
 
         """
-        # for each value in the node, if the user supplied value is smaller, insert the value and its ptr into that position
+        # find (binary search) the first value in the node that is larger than the user supplied value,
+        # and insert the value and its ptr into that position
         # if a second ptr is provided, insert it right next to the 1st ptr
         # else (no value in the node is larger) append value and ptr/s to the back of the list.
 
-        for index, existing_val in enumerate(self.values):
-            if value < existing_val:
-
-                self.values.insert(index, value)
-                if ptr is not None:
-                    self.ptrs.insert(index + 1, ptr)
+        index = bisect_right(self.values, value)
+        if index < len(self.values):
+            self.values.insert(index, value)
+            if ptr is not None:
+                # in a leaf, values and ptrs are parallel lists (the ptr of a value has the same index).
+                # in a non leaf node, the ptr of the new value points to the node on its right
+                self.ptrs.insert(index if self.is_leaf else index + 1, ptr)
 
-                if ptr1:
-                    self.ptrs.insert(index + 1, ptr1)
-                return
+            if ptr1:
+                self.ptrs.insert(index + 1, ptr1)
+            return
         self.values.append(value)
         if ptr is not None:
             self.ptrs.append(ptr)
@@ -108,23 +106,55 @@ class Node:
 
 
 class Btree:
-    def __init__(self, b):
+    def __init__(self, b, unique=True, include=()):
         """
         The tree abstraction.
+
+        unique: if False, a value can be inserted more than once. The leaves then keep a list of ptrs
+                (a posting list) for every value, instead of a single ptr.
+        include: the names of the (table) columns whose values are kept next to every ptr in the leaves
+                 (a covering index). Every ptr of a leaf is then a (ptr, included values) tuple. Def: () (none)
         """
         self.b = b  # branching factor
+        self.unique = unique
+        self.include = tuple(include)
         self.nodes = []  # list of nodes. Every new node is appended here
         self.root = None  # the index of the root node
 
         self.min_child_count = math.ceil(b / 2)
         self.min_leaf_count = math.ceil(b/2) - 1
 
+    def __setstate__(self, state):
+        """
+        Restore a pickled tree. Trees pickled by older versions of miniDB are always unique.
+        """
+        self.__dict__.update(state)
+        if 'unique' not in state:
+            self.unique = True
+        if 'include' not in state:
+            self.include = ()
+
+    def _entry(self, ptr, included):
+        """
+        Return what is stored in a leaf for ptr: ptr itself, or a (ptr, included values) tuple if the tree is covering.
+        """
+        return (ptr, tuple(included)) if self.include else ptr
+
+    def _ptr(self, entry):
+        """
+        Return the ptr of a leaf entry (see _entry).
+        """
+        return entry[0] if self.include else entry
 
-    def insert(self, value, ptr, rptr=None):
+    def insert(self, value, ptr, rptr=None, included=None):
         """
         Insert the value and its ptr/s to the appropriate node (node-level insertion is covered by the node object).
         User can input two ptrs to insert to a non leaf node.
+
+        included: the values of the included columns of the row, if the tree is covering (see include)
         """
+        # in a covering tree, the included values are stored next to the ptr
+        ptr = self._entry(ptr, included)
         # if the tree is empty, add the first node and set the root index to 0 (the only node's index)
         if self.root is None:
             self.nodes.append(Node(self.b, is_leaf=True))
@@ -132,21 +162,85 @@ class Btree:
 
         # find the index of the node that the value and its ptr/s should be inserted to (_search)
         index = self._search(value)
+        if not self.unique:
+            # if the value already exists, add the ptr to its posting list, else insert it with a new one
+            node = self.nodes[index]
+            idx = bisect_left(node.values, value)
+            if idx < len(node.values) and node.values[idx] == value:
+                node.ptrs[idx].append(ptr)
+                return
+            ptr = [ptr]
         # insert to it
         self.nodes[index].insert(value, ptr)
         # if the node has more elements than b-1, split the node
         if len(self.nodes[index].values) == self.b:
             self.split(index)
 
-    def replace_item(self, the_list, value, new_value):
+    def bulk_load(self, items, fill_factor=0.9):
         """
-        Replaces the value in the_list given with the new_value
+        Build the tree bottom-up from (value, ptr) pairs, replacing its contents.
+        The pairs are sorted once, packed into leaves (each filled to fill_factor of its capacity) that are linked
+        as siblings, and every internal level is built in one pass over the level below it.
+
+        items: iterable of (value, ptr) pairs (ie (key, row index)). Values must be unique, unless the tree is not.
+               If the tree is covering, (value, ptr, included values) triples.
+        fill_factor: fraction (0-1] of the b-1 slots of a node that are filled. Some room is left for later inserts.
         """
-        for index, item in enumerate(the_list):
-            if value == the_list[index]:
-                the_list[index] = new_value
-                return
-        return
+        if self.include:
+            items = [(item[0], self._entry(item[1], item[2])) for item in items]
+        items = sorted(items, key=lambda item: item[0])
+        self.nodes = []
+        self.root = None
+        if not items:
+            return
+        if not self.unique:
+            # group the ptrs of equal values into posting lists (sorted is stable, so they keep their order)
+            items = [(value, [ptr for _, ptr in group]) for value, group in groupby(items, key=lambda item: item[0])]
+
+        # leaves: split the sorted pairs into chunks of (almost) equal size, so that no leaf is left underfull
+        capacity = max(1, math.ceil((self.b - 1) * fill_factor))
+        level = []  # (node index, smallest value in the subtree) for every node of the level that is being built
+        for chunk in self._chunks(items, capacity):
+            idx = len(self.nodes)
+            leaf = Node(self.b, [value for value, _ in chunk], [ptr for _, ptr in chunk], is_leaf=True)
+            if level:
+                leaf.left_sibling = idx - 1
+                self.nodes[idx - 1].right_sibling = idx
+            self.nodes.append(leaf)
+            level.append((idx, chunk[0][0]))
+
+        # internal levels: a node gets up to b children, its values are the smallest values of the children
+        # on the right of the first (ie the first value of each child's leftmost leaf)
+        capacity = max(2, math.ceil(self.b * fill_factor))
+        while len(level) > 1:
+            parents = []
+            for chunk in self._chunks(level, capacity, minimum=2):
+                idx = len(self.nodes)
+                node = Node(self.b, [value for _, value in chunk[1:]], [child for child, _ in chunk])
+                for child, _ in chunk:
+                    self.nodes[child].parent = idx
+                self.nodes.append(node)
+                parents.append((idx, chunk[0][1]))
+            level = parents
+
+        self.root = level[0][0]
+
+    @staticmethod
+    def _chunks(seq, capacity, minimum=1):
+        """
+        Split seq into the least possible number of chunks of at most capacity elements, with sizes that differ
+        by at most one. If that would leave chunks smaller than minimum, fewer (larger) chunks are used.
+        """
+        count = math.ceil(len(seq) / capacity)
+        if count > 1 and len(seq) // count < minimum:
+            # ie 3 children with capacity 2 would give a parent with a single child
+            count = max(1, len(seq) // minimum)
+        size, extra = divmod(len(seq), count)
+        start = 0
+        for i in range(count):
+            end = start + size + (1 if i < extra else 0)
+            yield seq[start:end]
+            start = end
 
     def _search(self, value, return_ops=False, delete=False):
         """
@@ -158,15 +252,15 @@ class Btree:
         ops = 0  # number of operations (<>= etc). Used for benchmarking
 
         # start with the root node
-        node = self.nodes[self.root]
+        index = self.root
+        node = self.nodes[index]
         # while the node that we are searching in is not a leaf
-        # keep searching
+        # keep searching (and keep the index of the node we descend to)
         while not node.is_leaf:
-            idx, ops1 = node.find(value, return_ops=True)
-            node = self.nodes[idx]
+            index, ops1 = node.find(value, return_ops=True)
+            node = self.nodes[index]
             ops += ops1
 
-        index = self.nodes.index(node)
         # finally return the index of the appropriate node (and the ops if you want to)
         if return_ops:
             return index, ops
@@ -174,9 +268,14 @@ class Btree:
             return index
 
     # noinspection PyUnresolvedReferences
-    def delete(self, value):
+    def delete(self, value, ptr=None):
         """
-        Delete the value from the B+tree
+        Delete the value (and its ptr) from the B+tree.
+        Nodes left with too few values borrow one from a sibling, or are merged with it if it can not spare one.
+
+        value: the value that will be deleted
+        ptr: if the tree is not unique, only ptr is removed from the posting list of the value
+             (the value is deleted when its list is empty). Def: None (delete the value and all of its ptrs)
         """
         if self.root is None:
             print('Tree is empty')
@@ -184,404 +283,126 @@ class Btree:
 
         # Find the entry to be deleted
         index = self._search(value)
-        if value not in self.nodes[index].values:
+        node = self.nodes[index]
+        idx = bisect_left(node.values, value)
+        if idx == len(node.values) or node.values[idx] != value:
             print(f"Value [{value}] not found in the tree.")
             return
 
-        thisNode = self.nodes[index]
-
-        internalNode = self.checkifinternal(index, value)
-
-        # Find the value's index in the node so we can get the ptr and delete it
-        index_in_node = self.nodes[index].values.index(value)
-        ptr = self.nodes[index].ptrs[index_in_node]
-
-        rSibling = None
-        lSibling = None
-        if thisNode.right_sibling is not None:
-            rSibling = self.nodes[thisNode.right_sibling]
-        if thisNode.left_sibling is not None:
-            lSibling = self.nodes[thisNode.left_sibling]
-
-        # If right sibling and left siblings are children of the same parent
-        # then save them in different variables
-        rParSibling = None
-        lParSibling = None
-        if rSibling is not None and rSibling.parent == thisNode.parent:
-            rParSibling = rSibling
-        if lSibling is not None and lSibling.parent == thisNode.parent:
-            lParSibling = lSibling
-
-        # Delete entry from leaf.
-        thisNode.delete(value, ptr)
-
-        # If this leaf is left with less than the required amount of values then:
-        if len(thisNode.values) < self.min_leaf_count:
-            # if both siblings exist
-            if lParSibling is not None and rParSibling is not None:
-                # if both siblings have minimum amount of values
-                if len(lParSibling.values) <= self.min_leaf_count and len(rParSibling.values) <= self.min_leaf_count:
-                    # merge with lParSibling
-                    self.merge(index, thisNode, lSibling, value, 'left')
-                    if internalNode is not None:
-                        self.redistribute(index, thisNode, value, 'left', lSibling, thisNode.parent, internalNode=internalNode)
-                    else:
-                        self.redistribute(index, thisNode, value, 'left', lSibling, thisNode.parent)
-                # else 1 of the siblings has enough values, then
-                else:
-                    # if the left sibling has enough values
-                    if len(lParSibling.values) > self.min_leaf_count:
-                        # borrow from lParSibling
-                        self.borrow(thisNode, lSibling, 'left', value, internalNode)
-                    # else if the right sibling has enough values
-                    elif len(rParSibling.values) > self.min_leaf_count:
-                        # borrow from rParSibling
-                        # if the value is also in an internal node (is_internal = True)
-                        if internalNode is not None:
-                            # pass the internal node so the value in the internal node can be changed
-                            self.borrow(thisNode, rSibling, 'right', value, internalNode)
-                        else:
-                            # else the value might only be in the parent node
-                            self.borrow(thisNode, rSibling, 'right', value)
-            elif rParSibling is not None:
-                if len(rParSibling.values) <= self.min_leaf_count:
-                    # merge with rParSibling node
-                    if internalNode is not None:
-                        self.merge(index, thisNode, rSibling, value, 'right', internalNode)
-                        self.redistribute(index, thisNode, value, 'right', rSibling, thisNode.parent,internalNode=internalNode)
-                    else:
-                        self.merge(index, thisNode, rSibling, value, 'right')
-                        self.redistribute(index, thisNode, value, 'right', rSibling, thisNode.parent)
-                else:
-                    # borrow (from rParSibling)
-                    if internalNode is not None:
-                        self.borrow(thisNode, rSibling, 'right', value, internalNode)
-                    else:
-                        self.borrow(thisNode, rSibling, 'right', value)
-            elif lParSibling is not None:
-                if len(lParSibling.values) <= self.min_leaf_count:
-                    # merge with lParSibling node
-                    self.merge(index, thisNode, lSibling, value, 'left')
-                    if internalNode is not None:
-                        self.redistribute(index, thisNode, value, 'left', lSibling, thisNode.parent, internalNode=internalNode)
-                    else:
-                        self.redistribute(index, thisNode, value, 'left', lSibling, thisNode.parent)
-                else:
-                    # borrow (from lParSibling)
-                    self.borrow(thisNode, lSibling, 'left', value, internalNode)
-            # else there is no siblings with the same parent
-            else:
-                values = 0
-                lastNode = None
-                for i, node in enumerate(self.nodes):
-                    if node is not None:
-                        lastNode = node
-                        for j, val in enumerate(node.values):
-                            values += 1
-                if values == 0:
-                    self.nodes[index] = None
-                    self.nodes = []
-                    self.root = None
-        # else it has enough values and the value can simply be deleted
-        # but we have to delete it from the internal node (in case it's internal)
-        else:
-            if internalNode is not None:
-                for i, value1 in enumerate(internalNode.values):
-                    if value1 == value:
-                        internalNode.values[i] = thisNode.values[0]
+        if not self.unique and ptr is not None:
+            ptrs = node.ptrs[idx]
+            for i, entry in enumerate(ptrs):
+                if self._ptr(entry) == ptr:
+                    ptrs.pop(i)
+                    break
+            if ptrs:
+                return
+
+        # the value may still be used as a separator by an internal node. That is fine, separators only
+        # need to be bounds of the values of their children.
+        node.values.pop(idx)
+        node.ptrs.pop(idx)
+        self._rebalance(index)
 
-    def merge(self, thisNodeIndex, thisNode, siblingNode=None, deletedValue=None, siblingRorL=None, internalNode=None, mergeInternalNodes=False, parentNode=None, parentNodeIndex=None, parentOfParent=None):
+    def _rebalance(self, index):
         """
-        if mergeInternalNodes is False then it merges the leaf nodes
-        if mergeInternalNodes is True then it merges the internal nodes
+        Fix the node with index=index if it has too few values (leaf) or children (non leaf) after a delete.
         """
+        node = self.nodes[index]
 
-        # if we dont have to merge internal nodes
-        if not mergeInternalNodes:
-            index_sibling_node = self.nodes.index(siblingNode)
-
-            parentNode = self.nodes[thisNode.parent]
-            if deletedValue in parentNode.values:
-                parentNode.values.remove(deletedValue)
-            else:
-                if siblingRorL == 'left':
-                    parentNode.values.remove(thisNode.values[0])
-                elif siblingRorL == 'right':
-                    parentNode.values.remove(siblingNode.values[0])
-
-            if siblingRorL == 'left':
-                thisNode.left_sibling = siblingNode.left_sibling
-                if siblingNode.left_sibling is not None:
-                    self.nodes[siblingNode.left_sibling].right_sibling = thisNodeIndex
-            elif siblingRorL == 'right':
-                thisNode.right_sibling = siblingNode.right_sibling
-                if siblingNode.right_sibling is not None:
-                    self.nodes[siblingNode.right_sibling].left_sibling = thisNodeIndex
-
-            for i, value in enumerate(siblingNode.values):
-                thisNode.insert(siblingNode.values[i], siblingNode.ptrs[i])
-
-            if internalNode is not None:
-                for i, value in enumerate(internalNode.values):
-                    if value == deletedValue:
-                        internalNode.values[i] = thisNode.values[0]
-                        break
-
-            parentNode.ptrs.remove(index_sibling_node)
-            self.nodes[index_sibling_node] = None
-        # else we have to merge internal nodes
-        else:
-            if parentOfParent is None:
-                pass
-            else:
-                if len(parentNode.ptrs) < self.min_child_count:
-                    parentPtrsIndex = parentOfParent.ptrs.index(parentNodeIndex)
-                    if parentPtrsIndex > 0:
-                        mergeNodeIndex = parentOfParent.ptrs[parentPtrsIndex-1]
-                        leftOrRight = 'left'
-                    else:
-                        mergeNodeIndex = parentOfParent.ptrs[parentPtrsIndex+1]
-                        leftOrRight = 'right'
-
-                    if deletedValue in parentOfParent.values:
-                        parentOfParent.values.remove(deletedValue)
-
-                    mergeNode = self.nodes[mergeNodeIndex]
-                    for i, value in enumerate(parentNode.values):
-                        mergeNode.values.append(value)
-
-                    if leftOrRight == 'left':
-                        parentChildItemIndex = None
-                        if self.nodes[parentNode.ptrs[0]].values[0] in parentOfParent.values:
-                            parentChildItemIndex = parentOfParent.values.index(self.nodes[parentNode.ptrs[0]].values[0])
-
-
-                        for i, ptr in enumerate(parentNode.ptrs):
-                            mergeNode.ptrs.append(ptr)
-
-                            if self.nodes[ptr].parent != mergeNodeIndex:
-                                self.nodes[ptr].parent = mergeNodeIndex
+        if index == self.root:
+            # a root with a single child is replaced by the child (the tree gets shorter)
+            if not node.is_leaf and len(node.ptrs) == 1:
+                self.root = node.ptrs[0]
+                self.nodes[self.root].parent = None
+                self.nodes[index] = None
+            return
 
-                        if parentChildItemIndex is None:
-                            popped = parentOfParent.values.pop(0)
-                            mergeNode.values.append(popped)
-                        else:
-                            popped = parentOfParent.values.pop(parentChildItemIndex)
-                            mergeNode.values.append(popped)
+        if node.is_leaf and len(node.values) >= self.min_leaf_count:
+            return
+        if not node.is_leaf and len(node.ptrs) >= self.min_child_count:
+            return
 
-                    else:
-                        for i, ptr in reversed(list(enumerate(parentNode.ptrs))):
-                            mergeNode.ptrs.insert(0,ptr)
-                            if self.nodes[ptr].parent != mergeNodeIndex:
-                                self.nodes[ptr].parent = mergeNodeIndex
-
-                        popped = parentOfParent.values.pop(0)
-                        mergeNode.values.insert(0, popped)
-
-                    mergeNode.values.sort()
-
-                    thisNode.parent = mergeNodeIndex
-                    self.nodes[parentNodeIndex] = None
-                    parentOfParent.ptrs.remove(parentNodeIndex)
-
-                    return True
-
-                return False
-
-    def borrow(self, thisNode, siblingNode=None, siblingRorL=None, deletedValue=None, internalNode=None, borrowNode=False):
-        """
-        If borrowNode is False then it borrows a value from a sibling
-        If borrowNode is True then it borrows a node from a sibling parent
-        """
-
-        if not borrowNode:
-            parentNode = self.nodes[thisNode.parent]
-            if siblingRorL == 'right':
-                borrowed_value = siblingNode.values[0]
-                borrowed_ptr = siblingNode.ptrs[0]
-                thisNode.insert(borrowed_value, borrowed_ptr)
-                siblingNode.delete(borrowed_value, borrowed_ptr)
-                for i, value in enumerate(parentNode.values):
-                    if value == borrowed_value:
-                        parentNode.values[i] = siblingNode.values[0]
-                        break
-                if internalNode is not None:
-                    for i, value in enumerate(internalNode.values):
-                        if value == deletedValue:
-                            internalNode.values[i] = thisNode.values[0]
-                            break
-            elif siblingRorL == 'left':
-                borrowed_value = siblingNode.values[-1]
-                borrowed_ptr = siblingNode.ptrs[-1]
-                thisNode.insert(borrowed_value, borrowed_ptr)
-                siblingNode.delete(borrowed_value, borrowed_ptr)
-                if deletedValue in parentNode.values:
-                    for i, value in enumerate(parentNode.values):
-                        if value == deletedValue:
-                            parentNode.values[i] = thisNode.values[0]
-                            break
-                else:
-                    for i, value in enumerate(parentNode.values):
-                        if value == thisNode.values[1]:
-                            parentNode.values[i] = thisNode.values[0]
-                            break
+        # the siblings that share a parent with the node
+        parent = self.nodes[node.parent]
+        pos = parent.ptrs.index(index)
+        left = parent.ptrs[pos - 1] if pos > 0 else None
+        right = parent.ptrs[pos + 1] if pos + 1 < len(parent.ptrs) else None
+
+        # borrow from a sibling that has more than the minimum
+        if left is not None and self._can_spare(self.nodes[left]):
+            self._borrow_from_left(index, left, pos)
+        elif right is not None and self._can_spare(self.nodes[right]):
+            self._borrow_from_right(index, right, pos)
+        # else merge with a sibling (the right one into the left one), the parent loses a child
+        elif left is not None:
+            self._merge(left, index, pos - 1)
+            self._rebalance(node.parent)
         else:
-            borrowed = False
-            parentNode = self.nodes[thisNode.parent]
-            # leftParentInd is the left sibling index of the current's node parent
-            # rightParentInd is the right sibling index of the current's node parent
-
-            leftParentInd, rightParentInd = self.getsiblingsofparent(thisNode)
-
-            leftParSibNode = None
-            if leftParentInd != -1:
-                leftParSibNode = self.nodes[leftParentInd]
-
-            rightParSibNode = None
-            if rightParentInd != -1:
-                rightParSibNode = self.nodes[rightParentInd]
-
-            # if the left sibling of the parent exists and it has enough children
-            if leftParSibNode is not None and len(leftParSibNode.ptrs) > self.min_child_count:
-                borrowedNode = self.nodes[leftParSibNode.ptrs[-1]]
-                borrowedNodeIndex = leftParSibNode.ptrs[-1]
-                leftParSibNode.ptrs.remove(borrowedNodeIndex)
-                parentNode.ptrs.insert(0, borrowedNodeIndex)
-
-                leftParSibNode.values.pop(-1)
-                thisNodeIndex = self.nodes.index(thisNode)
-
-                internal_nd = self.checkifinternal(thisNodeIndex, thisNode.values[0])
-                if internal_nd is not None:
-                    self.replace_item(internal_nd.values, thisNode.values[0], borrowedNode.values[0])
-                parentNode.values.insert(0, thisNode.values[0])
-
-                borrowedNode.parent = thisNode.parent
-                borrowed = True
-            # else if the right sibling of the parent exists and it has enough children
-            elif rightParSibNode is not None and len(rightParSibNode.ptrs) > self.min_child_count:
-                borrowedNode = self.nodes[rightParSibNode.ptrs[0]]
-                borrowedNodeIndex = rightParSibNode.ptrs[0]
-                rightParSibNode.ptrs.remove(borrowedNodeIndex)
-                parentNode.ptrs.append(borrowedNodeIndex)
-
-                rightParSibNode.values.pop(0)
-                parentNode.values.append(borrowedNode.values[0])
-                internal_nd = self.checkifinternal(borrowedNodeIndex, borrowedNode.values[0])
-                if internal_nd is not None:
-                    self.replace_item(internal_nd.values, borrowedNode.values[0], self.nodes[rightParSibNode.ptrs[0]].values[0])
-
-                borrowedNode.parent = thisNode.parent
-                borrowed = True
-
-            return borrowed
-
-    def redistribute(self, thisNodeIndex, thisNode, deletedValue, siblingRorL, siblingNode, parentIndex, internalNode=None):
-        """
-        Rearranges the internal nodes based on their children count
-        """
-
-        if parentIndex == self.root:
-            parentNode = self.nodes[parentIndex]
-            if len(self.nodes[self.root].values) == 0:
-                # thisNode.is_leaf = False
-                self.nodes[self.root] = None
-                self.root = thisNodeIndex
-                self.nodes[self.root].parent = None
-                return
+            self._merge(index, right, pos)
+            self._rebalance(node.parent)
 
-        # If the children count of the parent is lower than the minimum child count then it borrows an internal node
-        if len(self.nodes[parentIndex].ptrs) < self.min_child_count:
-            borrowed = self.borrow(thisNode, borrowNode=True)
-            # if it didnt borrow any child
-            if not borrowed:
-                # then internal nodes have to be merged
-                currentNodeIndex = thisNodeIndex
-                currentNode = thisNode
-                parentNode = self.nodes[currentNode.parent]
-                parentNdIndex = currentNode.parent
-                parentOfParent = None
-                if parentNode.parent is not None:
-                    parentOfParent = self.nodes[parentNode.parent]
-
-                while len(parentNode.ptrs) < self.min_child_count:
-                    merged = self.merge(currentNodeIndex, currentNode, mergeInternalNodes=True, parentNode=parentNode, parentNodeIndex=parentNdIndex, parentOfParent=parentOfParent)
-
-                    if not merged:
-                        break
-
-                    if parentOfParent is not None:
-                        currentNodeIndex = currentNode.parent
-                        currentNode = parentNode
-                        parentNode = parentOfParent
-                        for i, node in enumerate(self.nodes):
-                            if node == parentNode:
-                                parentNdIndex = i
-                                break
-                        parentOfParent = None
-                        if parentNode.parent is not None:
-                            parentOfParent = self.nodes[parentNode.parent]
-
-                    if len(self.nodes[self.root].values) == 0:
-                        new_root = self.nodes[self.root].ptrs[0]
-                        self.nodes[self.root] = None
-                        self.root = new_root
-                        self.nodes[self.root].parent = None
-                        break
-        else:
-            return
+    def _can_spare(self, node):
+        if node.is_leaf:
+            return len(node.values) > self.min_leaf_count
+        return len(node.ptrs) > self.min_child_count
 
-    def getsiblingsofparent(self, thisNode):
+    def _borrow_from_left(self, index, left_index, pos):
         """
-        returns the indexes of the parent's siblings
+        Move the last value/ptr of the left sibling to the node. pos is the position of the node in its parent's ptrs.
         """
-        if thisNode.parent is None:
-            return -1, -1
-
-        nextLeft = None
-        if thisNode.left_sibling is not None:
-            nextLeft = self.nodes[thisNode.left_sibling]
-            while nextLeft.parent == thisNode.parent:
-                if nextLeft.left_sibling is not None:
-                    nextLeft = self.nodes[nextLeft.left_sibling]
-                else:
-                    nextLeft = None
-                    break
-
-        nextRight = None
-        if thisNode.right_sibling is not None:
-            nextRight = self.nodes[thisNode.right_sibling]
-            while nextRight.parent == thisNode.parent:
-                if nextRight.right_sibling is not None:
-                    nextRight = self.nodes[nextRight.right_sibling]
-                else:
-                    nextRight = None
-                    break
-
-        if nextLeft is not None and nextRight is not None:
-            return nextLeft.parent, nextRight.parent
-        elif nextLeft is not None:
-            return nextLeft.parent, -1
-        elif nextRight is not None:
-            return -1, nextRight.parent
-
-        return -1, -1
+        node, left, parent = self.nodes[index], self.nodes[left_index], self.nodes[self.nodes[index].parent]
+        if node.is_leaf:
+            node.values.insert(0, left.values.pop())
+            node.ptrs.insert(0, left.ptrs.pop())
+            parent.values[pos - 1] = node.values[0]
+        else:
+            # the separator moves down to the node and the last value of the sibling moves up to the parent
+            node.values.insert(0, parent.values[pos - 1])
+            node.ptrs.insert(0, left.ptrs.pop())
+            parent.values[pos - 1] = left.values.pop()
+            self.nodes[node.ptrs[0]].parent = index
 
-    def checkifinternal(self, currentNodeIndex, value):
+    def _borrow_from_right(self, index, right_index, pos):
         """
-        Checks if value is present in an internal node
-        If it is present it returns the internal node
-        else it returns None
+        Move the first value/ptr of the right sibling to the node. pos is the position of the node in its parent's ptrs.
         """
-        is_internal = False
-        internalNode = self.nodes[currentNodeIndex]
-        while internalNode.parent is not None:
-            internalNode = self.nodes[internalNode.parent]
-            if value in internalNode.values:
-                is_internal = True
-                return internalNode
-
-        return None
+        node, right, parent = self.nodes[index], self.nodes[right_index], self.nodes[self.nodes[index].parent]
+        if node.is_leaf:
+            node.values.append(right.values.pop(0))
+            node.ptrs.append(right.ptrs.pop(0))
+            parent.values[pos] = right.values[0]
+        else:
+            # the separator moves down to the node and the first value of the sibling moves up to the parent
+            node.values.append(parent.values[pos])
+            node.ptrs.append(right.ptrs.pop(0))
+            parent.values[pos] = right.values.pop(0)
+            self.nodes[node.ptrs[-1]].parent = index
+
+    def _merge(self, left_index, right_index, pos):
+        """
+        Merge the right node into the left one (its left sibling) and remove it from the tree.
+        pos is the position of the left node in its parent's ptrs.
+        """
+        left, right = self.nodes[left_index], self.nodes[right_index]
+        parent = self.nodes[left.parent]
+        if left.is_leaf:
+            left.values.extend(right.values)
+            left.ptrs.extend(right.ptrs)
+            # unlink the right node from the leaf chain
+            left.right_sibling = right.right_sibling
+            if right.right_sibling is not None:
+                self.nodes[right.right_sibling].left_sibling = left_index
+        else:
+            # the separator of the two nodes moves down to the merged node
+            left.values.append(parent.values[pos])
+            left.values.extend(right.values)
+            left.ptrs.extend(right.ptrs)
+            for child in right.ptrs:
+                self.nodes[child].parent = left_index
+        parent.values.pop(pos)
+        parent.ptrs.pop(pos + 1)
+        self.nodes[right_index] = None
 
     def split(self, node_id):
         """
@@ -626,11 +447,14 @@ class Btree:
                 self.nodes[ptr].parent = len(self.nodes)
 
         # old node (left) keeps only the first half of the values/ptrs
-        node.values = node.values[:len(node.values) // 2]
-        if self.b % 2 == 1:
+        # (in a leaf values and ptrs are parallel, in a non leaf node there is one more ptr than values)
+        if node.is_leaf:
+            node.ptrs = node.ptrs[:len(node.values) // 2]
+        elif self.b % 2 == 1:
             node.ptrs = node.ptrs[:len(node.ptrs) // 2]
         else:
             node.ptrs = node.ptrs[:len(node.ptrs) // 2 + 1]
+        node.values = node.values[:len(node.values) // 2]
 
         # append the new node (right) to the nodes list
         self.nodes.append(right)
@@ -709,67 +533,85 @@ class Btree:
             with open('graph.gv', 'w') as f:
                 f.write(g)
 
-    def find(self, operator, value):
+    def range(self, lo=None, hi=None, lo_inclusive=True, hi_inclusive=True, with_included=False):
+        """
+        Lazily iterate over the (value, ptr) entries with lo </<= value </<= hi, in ascending order of value.
+        The leaf of lo is found with a single search, then the leaf chain is followed until a value is past hi,
+        so a bounded range costs O(log n + k). For a non unique tree, every ptr of a posting list is a separate entry.
+        The tree should not be changed while iterating.
+
+        lo, hi: the bounds of the range. None means unbounded on that side. Def: None
+        lo_inclusive, hi_inclusive: whether a value equal to the bound is part of the range. Def: True
+        with_included: if True (covering trees only), the entries are (value, ptr, included values). Def: False
+        """
+        if self.root is None:
+            return
+        if lo is None:
+            # start from the leftmost leaf
+            node = self.nodes[self.root]
+            while not node.is_leaf:
+                node = self.nodes[node.ptrs[0]]
+            idx = 0
+        else:
+            node = self.nodes[self._search(lo)]
+            idx = bisect_left(node.values, lo) if lo_inclusive else bisect_right(node.values, lo)
+
+        while True:
+            for i in range(idx, len(node.values)):
+                value = node.values[i]
+                if hi is not None and (value > hi or (value == hi and not hi_inclusive)):
+                    return
+                for entry in ([node.ptrs[i]] if self.unique else node.ptrs[i]):
+                    if with_included:
+                        yield value, entry[0], entry[1]
+                    else:
+                        yield value, self._ptr(entry)
+            if node.right_sibling is None:
+                return
+            node = self.nodes[node.right_sibling]
+            idx = 0
+
+    def find(self, operator, value, return_ops=False):
         """
         Return ptrs of elements where btree_value"operator"value.
         Important, the user supplied "value" is the right value of the operation. That is why the operation are reversed below.
         The left value of the op is the btree value.
+
+        return_ops: set to True if you want to use the number of operations (returned instead of printed)
         """
         results = []
-        # find the index of the node that the element should exist in
-        leaf_idx, ops = self._search(value, True)
-        target_node = self.nodes[leaf_idx]
+        if self.root is None:
+            return (results, 0) if return_ops else results
 
         if operator == '==':
+            # find the index of the node that the element should exist in
+            leaf_idx, ops = self._search(value, True)
+            target_node = self.nodes[leaf_idx]
             # if the element exist, append to list, else pass and return
-            # noinspection PyBroadException
-            try:
-                results.append(target_node.ptrs[target_node.values.index(value)])
-                # print('Found')
-            except:
-                # print('Not found')
-                pass
-
-        # for all other ops, the code is the same, only the operations themselves and the sibling indexes change
-        # for > and >= (btree value is >/>= of user supplied value), we return all the right siblings (all values are larger than current cell)
-        # for < and <= (btree value is </<= of user supplied value), we return all the left siblings (all values are smaller than current cell)
-
-        if operator == '>':
-            for idx, node_value in enumerate(target_node.values):
-                ops += 1
-                if node_value > value:
-                    results.append(target_node.ptrs[idx])
-            while target_node.right_sibling is not None:
-                target_node = self.nodes[target_node.right_sibling]
-                results.extend(target_node.ptrs)
-
-        if operator == '>=':
-            for idx, node_value in enumerate(target_node.values):
-                ops += 1
-                if node_value >= value:
-                    results.append(target_node.ptrs[idx])
-            while target_node.right_sibling is not None:
-                target_node = self.nodes[target_node.right_sibling]
-                results.extend(target_node.ptrs)
-
-        if operator == '<':
-            for idx, node_value in enumerate(target_node.values):
-                ops += 1
-                if node_value < value:
-                    results.append(target_node.ptrs[idx])
-            while target_node.left_sibling is not None:
-                target_node = self.nodes[target_node.left_sibling]
-                results.extend(target_node.ptrs)
-
-        if operator == '<=':
-            for idx, node_value in enumerate(target_node.values):
-                ops += 1
-                if node_value <= value:
-                    results.append(target_node.ptrs[idx])
-            while target_node.left_sibling is not None:
-                target_node = self.nodes[target_node.left_sibling]
-                results.extend(target_node.ptrs)
+            idx = bisect_left(target_node.values, value)
+            if idx < len(target_node.values) and target_node.values[idx] == value:
+                results.append(target_node.ptrs[idx])
+            if not self.unique:
+                # the result is a posting list
+                results = [ptr for ptrs in results for ptr in ptrs]
+            if self.include:
+                results = [self._ptr(entry) for entry in results]
+        else:
+            # for all other ops, the results are a range of the leaf chain:
+            # for > and >= (btree value is >/>= of user supplied value) the range starts at the value and is not bounded on the right,
+            # for < and <= (btree value is </<= of user supplied value) it starts at the leftmost leaf and ends at the value
+            if operator in ('>', '>='):
+                entries = self.range(lo=value, lo_inclusive=operator == '>=')
+                ops = self._search(value, True)[1]
+            else:
+                entries = self.range(hi=value, hi_inclusive=operator == '<=')
+                ops = 0
+            results = [ptr for _, ptr in entries]
+            # one comparison per entry in the range
+            ops += len(results)
 
+        if return_ops:
+            return results, ops
         # print the number of operations (usefull for benchamrking)
         print(f'With BTree -> {ops} comparison operations')
         return results
\ No newline at end of file
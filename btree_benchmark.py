@@ -0,0 +1,49 @@
+from btree import Btree
+from time import perf_counter
+import random
+
+'''
+Benchmark Btree construction and lookups
+
+A tree is built with N random keys, once by inserting the keys one by one and once with bulk_load,
+and we time random point lookups (find with "==") on it.
+The cost of a lookup should grow with the height of the tree (log N), not with the number of nodes.
+'''
+
+SIZES = [10**5, 10**6]
+LOOKUPS = 10000
+B = 3
+
+random.seed(0)
+
+
+def height(bt):
+    node, levels = bt.nodes[bt.root], 1
+    while not node.is_leaf:
+        node, levels = bt.nodes[node.ptrs[0]], levels + 1
+    return levels
+
+
+print(f'{"keys":>8}  {"build":>6}  {"nodes":>8}  {"height":>6}  {"build (s)":>10}  {"us/lookup":>10}')
+
+for size in SIZES:
+    keys = random.sample(range(size*10), size)
+    probes = random.choices(keys, k=LOOKUPS)
+
+    for build in ['insert', 'bulk']:
+        start = perf_counter()
+        bt = Btree(B)
+        if build == 'insert':
+            for ptr, key in enumerate(keys):
+                bt.insert(key, ptr)
+        else:
+            bt.bulk_load((key, ptr) for ptr, key in enumerate(keys))
+        elapsed_build = perf_counter() - start
+
+        start = perf_counter()
+        for key in probes:
+            bt.find('==', key, return_ops=True)
+        elapsed = perf_counter() - start
+
+        print(f'{size:>8}  {build:>6}  {len(bt.nodes):>8}  {height(bt):>6}  {elapsed_build:>10.2f}  {elapsed/LOOKUPS*1e6:>10.2f}')
+        del bt
@@ -0,0 +1,248 @@
+'''
+Typed column containers used by the columnar storage backend of Table.
+
+int/float/bool columns are stored in array buffers (8/8/1 bytes per value) with a null map
+(one byte per value, 1 for deleted rows). str columns are dictionary encoded: every distinct
+string is stored once and the column keeps an array of codes (-1 for deleted rows).
+Every other type is kept in a plain list.
+
+The containers behave like the lists used by the row backend (len, indexing, iteration, append,
+extend, pop, index, in), so the rest of the code does not need to know which backend a table uses.
+They also offer where(), a scan that returns the indexes of the values that satisfy a condition.
+If NumPy is installed the scan is vectorized.
+'''
+from array import array
+from itertools import compress, count, repeat
+from misc import OPS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TYPECODES = {int: 'q', float: 'd', bool: 'b'}
+
+
+def make_column(column_type, values=()):
+    '''
+    Return the appropriate container for a column of type column_type, filled with values.
+    '''
+    if column_type in TYPECODES:
+        return TypedColumn(column_type, values)
+    if column_type is str:
+        return DictColumn(values)
+    return list(values)
+
+
+class TypedColumn:
+    '''
+    int/float/bool column stored in an array buffer, with a null map for deleted rows.
+    '''
+    def __init__(self, column_type, values=()):
+        self.column_type = column_type
+        self._values = array(TYPECODES[column_type])
+        self._nulls = bytearray()
+        self.extend(values)
+
+    def _promote(self):
+        '''
+        Switch to a list buffer (used when a value does not fit in the array, ie an int larger than 64 bits).
+        '''
+        self._values = list(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(len(self))[idx]]
+        if self._nulls[idx]:
+            return None
+        if self.column_type is bool:
+            return bool(self._values[idx])
+        return self._values[idx]
+
+    def __setitem__(self, idx, value):
+        if value is None:
+            self._nulls[idx] = 1
+            self._values[idx] = 0
+            return
+        try:
+            self._values[idx] = value
+        except (OverflowError, TypeError):
+            self._promote()
+            self._values[idx] = value
+        self._nulls[idx] = 0
+
+    def __iter__(self):
+        cast = bool if self.column_type is bool else None
+        for value, is_null in zip(self._values, self._nulls):
+            if is_null:
+                yield None
+            else:
+                yield cast(value) if cast else value
+
+    def __contains__(self, value):
+        return any(x == value for x in self)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, value):
+        self._values.append(0)
+        self._nulls.append(0)
+        self[len(self._values)-1] = value
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def pop(self, idx=-1):
+        value = self[idx]
+        self._values.pop(idx)
+        self._nulls.pop(idx)
+        return value
+
+    def index(self, value):
+        for idx, x in enumerate(self):
+            if x == value:
+                return idx
+        raise ValueError(f'{value} is not in column')
+
+    def where(self, op, value):
+        '''
+        Return the indexes of the non deleted values x where x "op" value is True.
+        '''
+        if np is not None and isinstance(self._values, array):
+            values = np.frombuffer(self._values, dtype=self._values.typecode)
+            nulls = np.frombuffer(self._nulls, dtype=np.uint8)
+            return np.flatnonzero(OPS[op](values, value) & (nulls == 0)).tolist()
+        # deleted rows hold a 0 in the buffer, so every value can be compared. They are filtered out afterwards
+        rows = compress(count(), map(OPS[op], self._values, repeat(value)))
+        nulls = self._nulls
+        if 1 in nulls:
+            return [idx for idx in rows if not nulls[idx]]
+        return list(rows)
+
+
+class DictColumn:
+    '''
+    str column stored as an array of codes pointing to a dictionary of distinct values (-1 means deleted).
+    '''
+    def __init__(self, values=()):
+        self._codes = array('i')
+        self._dictionary = []  # code -> value
+        self._lookup = {}  # value -> code
+        self.extend(values)
+
+    def _encode(self, value):
+        if value is None:
+            return -1
+        code = self._lookup.get(value)
+        if code is None:
+            code = len(self._dictionary)
+            self._dictionary.append(value)
+            self._lookup[value] = code
+        return code
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(len(self))[idx]]
+        code = self._codes[idx]
+        return None if code == -1 else self._dictionary[code]
+
+    def __setitem__(self, idx, value):
+        self._codes[idx] = self._encode(value)
+
+    def __iter__(self):
+        dictionary = self._dictionary
+        for code in self._codes:
+            yield None if code == -1 else dictionary[code]
+
+    def __contains__(self, value):
+        return value in self._lookup and self._lookup[value] in self._codes
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, value):
+        self._codes.append(self._encode(value))
+
+    def extend(self, values):
+        self._codes.extend(self._encode(value) for value in values)
+
+    def pop(self, idx=-1):
+        value = self[idx]
+        self._codes.pop(idx)
+        return value
+
+    def index(self, value):
+        if value in self._lookup:
+            return self._codes.index(self._lookup[value])
+        raise ValueError(f'{value} is not in column')
+
+    def where(self, op, value):
+        '''
+        Return the indexes of the non deleted values x where x "op" value is True.
+        The condition is evaluated once per distinct value, the scan only compares codes.
+        '''
+        func = OPS[op]
+        codes = {code for code, x in enumerate(self._dictionary) if func(x, value)}
+        if np is not None:
+            column = np.frombuffer(self._codes, dtype=np.int32)
+            return np.flatnonzero(np.isin(column, list(codes))).tolist()
+        if len(codes) == 1:
+            code = codes.pop()
+            return [idx for idx, x in enumerate(self._codes) if x == code]
+        return [idx for idx, x in enumerate(self._codes) if x in codes]
+
+
+class RowView:
+    '''
+    Row oriented view over the columns of a columnar table. It is what table.data is for such a table.
+    Reading a row returns a new list, writing one writes its values to the columns.
+    '''
+    def __init__(self, columns):
+        self._columns = columns
+
+    def __len__(self):
+        return len(self._columns[0]) if self._columns else 0
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(len(self))[idx]]
+        return [column[idx] for column in self._columns]
+
+    def __setitem__(self, idx, row):
+        for column, value in zip(self._columns, row):
+            column[idx] = value
+
+    def __iter__(self):
+        return (list(row) for row in zip(*self._columns))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, row):
+        for column, value in zip(self._columns, row):
+            column.append(value)
+
+    def extend(self, rows):
+        rows = list(rows)
+        for i, column in enumerate(self._columns):
+            column.extend([row[i] for row in rows])
+
+    def pop(self, idx=-1):
+        return [column.pop(idx) for column in self._columns]
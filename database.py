@@ -4,27 +4,78 @@ from table import Table
 from time import sleep, localtime, strftime
 import os
 from btree import Btree
+from hash_index import HashIndex
+from lock_manager import LockManager, LockTimeout, is_alive
+from wal import WriteAheadLog
 import shutil
-from misc import split_condition
+import stat
+import tempfile
+import csv
+import gzip
+from contextlib import contextmanager
+from itertools import islice, count
+from misc import split_condition, split_conditions
+
+# schema of the meta_indexes table. column_name is the indexed column, index_type 'Btree' or 'Hash',
+# b the branching factor of a btree and page_size the byte budget its nodes were sized to
+# (0 if b was given explicitly, both are 0 for a hash index), include the columns stored in the leaves of a covering btree
+META_INDEXES_COLUMNS = ['table_name', 'index_name', 'column_name', 'index_type', 'b', 'page_size', 'include']
+META_INDEXES_TYPES = [str, str, str, str, int, int, list]
+
+# updates lock pages of ROWS_PER_PAGE consecutive rows instead of the whole table. An update
+# that touches more than LOCK_ESCALATION pages locks the whole table instead (lock escalation)
+ROWS_PER_PAGE = 64
+LOCK_ESCALATION = 16
+
+# the write-ahead log is checkpointed (the changed tables are saved and the log is emptied)
+# once it grows past CHECKPOINT_SIZE bytes
+CHECKPOINT_SIZE = 4*2**20
+
+# the umask of the process (it can only be read by setting it), new files get mode 0o666 & ~UMASK
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 class Database:
     '''
     Database class contains tables.
     '''
 
-    def __init__(self, name, load=True):
+    def __init__(self, name, load=True, lock_timeout=10):
         self.tables = {}
         self._name = name
+        # the on disk signature (mtime, size) of each table file, as it was when we last loaded or saved it.
+        # This lets load skip every table that has not been changed (by another process) since then.
+        self._signatures = {}
+        # index_name -> (signature, btree) of the btrees loaded or saved by this object, so that a btree is only
+        # unpickled again when its file has changed (see _load_idx)
+        self._index_cache = {}
 
         self.savedir = f'dbdata/{name}_db'
+        # table locks (S/X flocks on the files of savedir/locks), see lock_manager
+        self._locks = LockManager(f'{self.savedir}/locks')
+        # the number of seconds a table function waits for a locked table before it raises LockTimeout (None waits for ever)
+        self.lock_timeout = lock_timeout
+        # write-ahead log of the changes to the tables (see wal.py), the tables themselves are only saved at checkpoints
+        self._wal = WriteAheadLog(f'{self.savedir}/wal.log')
+        # (generation, offset) of the log: the records before offset are part of the tables in memory
+        self._wal_position = (None, 0)
+        # the records appended by this object are tagged with its id (so they are not replayed to it) and a sequence number
+        self._wal_writer = os.urandom(8).hex()
+        self._wal_seq = count()
+        # (writer, seq) -> (pid, table_name) for the logged changes of other writers that have not reached the indexes yet
+        self._unindexed = {}
 
         if load:
             try:
                 self.load(self.savedir)
-                print(f'Loaded "{name}".')
-                return
+            except LockTimeout:
+                raise
             except:
                 print(f'"{name}" db does not exist, creating new.')
+            else:
+                print(f'Loaded "{name}".')
+                self._recover()
+                return
 
         # create dbdata directory if it doesnt exist
         if not os.path.exists('dbdata'):
@@ -36,11 +87,18 @@ class Database:
         except:
             pass
 
+        # a new db replaces the one saved in its directory (if any): its tables, indexes and log are removed,
+        # so that they are neither loaded nor replayed to the new one
+        with self._log_lock('X'):
+            for file in os.listdir(self.savedir):
+                if file[-3:]=='pkl' or file=='wal.log':
+                    os.remove(f'{self.savedir}/{file}')
+            shutil.rmtree(f'{self.savedir}/indexes', ignore_errors=True)
+
         # create all the meta tables
         self.create_table('meta_length',  ['table_name', 'no_of_rows'], [str, int])
-        self.create_table('meta_locks',  ['table_name', 'locked'], [str, bool])
         self.create_table('meta_insert_stack',  ['table_name', 'indexes'], [str, list])
-        self.create_table('meta_indexes',  ['table_name', 'index_name'], [str, str])
+        self.create_table('meta_indexes',  META_INDEXES_COLUMNS, META_INDEXES_TYPES)
         self.save()
 
 
@@ -48,32 +106,342 @@ class Database:
     def save(self):
         '''
         Save db as a pkl file. This method saves the db object, ie all the tables and attributes.
+        Only the tables that have changed since they were last saved (dirty tables) are written.
+
+        Saving is a checkpoint of the write-ahead log: the changes that every writer has logged are applied
+        first (load), then the tables are written and the log is emptied.
         '''
-        for name, table in self.tables.items():
-            with open(f'{self.savedir}/{name}.pkl', 'wb') as f:
-                pickle.dump(table, f)
+        with self._log_lock('X'):
+            self.load(self.savedir)
+            self._update()
+            self._repair_indexes()
+            for name, table in self.tables.items():
+                # tables pickled before dirty tracking existed do not have the flag
+                if not getattr(table, '_dirty', True):
+                    continue
+                table._dirty = False
+                try:
+                    self._dump(table, f'{self.savedir}/{name}.pkl', sync=True)
+                except:
+                    table._dirty = True
+                    raise
+                self._signatures[name] = self._signature(f'{self.savedir}/{name}.pkl')
+            self._wal.truncate()
+            self._wal_position = (self._wal.generation(), 0)
+
+    def _dump(self, obj, filename, write=pickle.dump, sync=False):
+        '''
+        Pickle obj to filename. The object is first written to a temp file that is then renamed to filename,
+        so a reader (or a crash) never sees a half written file.
 
-    def _save_locks(self):
+        write -> the function that writes obj to the (binary) file, write(obj, f). Def: pickle.dump
+        sync -> If True, the file is fsynced before it is renamed (ie before the log it replaces is emptied). Def: False
         '''
-        Save db as a pkl file. This method saves the db object, ie all the tables and attributes.
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # mkstemp creates the file for its owner only. It gets the mode of the file it replaces
+                # (or the default mode of a new file), like a file that is written in place
+                try:
+                    mode = stat.S_IMODE(os.stat(filename).st_mode)
+                except FileNotFoundError:
+                    mode = 0o666 & ~UMASK
+                os.fchmod(f.fileno(), mode)
+                write(obj, f)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_filename, filename)
+        except:
+            os.remove(tmp_filename)
+            raise
+
+    def _signature(self, filename):
+        '''
+        Return a cheap signature (modification time and size) of a table file.
         '''
-        with open(f'{self.savedir}/meta_locks.pkl', 'wb') as f:
-            pickle.dump(self.tables['meta_locks'], f)
+        stat = os.stat(filename)
+        return stat.st_mtime_ns, stat.st_size
 
     def load(self, path):
         '''
         Load all the tables that are part of the db (indexs are noted loaded here)
+        Tables whose file has not changed since they were last loaded or saved are kept as they are in memory.
+        Tables whose file was removed (dropped by another process) are removed from memory as well.
+        Then the changes that other writers have appended to the write-ahead log since the last load are applied.
+        '''
+        # raises if the db does not exist (locking would create its directory)
+        os.listdir(path)
+        with self._log_lock('S'):
+            self._load(path)
+
+    def _load_snapshot(self, table_names):
         '''
+        Load for a reader (select, show_table, inner_join), that never waits for the log lock: if the log is
+        X locked (by a checkpoint or a function that changes a whole table), the tables in memory, the snapshot
+        of our last load, are read instead. Unless a table the reader needs is not in memory yet.
+
+        table_names -> the tables that will be read
+        '''
+        os.listdir(self.savedir)
+        try:
+            self._locks.lock('meta_wal', 'S', 0)
+        except LockTimeout:
+            if any(name not in self.tables for name in table_names):
+                self.load(self.savedir)
+            return
+        try:
+            self._load(self.savedir)
+        finally:
+            self._locks.unlock('meta_wal')
+
+    def _load(self, path):
+        on_disk = set()
+        reloaded = []
         for file in os.listdir(path):
 
             if file[-3:]!='pkl': # if used to load only pkl files
                 continue
-            f = open(path+'/'+file, 'rb')
-            tmp_dict = pickle.load(f)
-            f.close()
             name = f'{file.split(".")[0]}'
-            self.tables.update({name: tmp_dict})
-            setattr(self, name, self.tables[name])
+            on_disk.add(name)
+            if self._load_table(name, path):
+                reloaded.append(name)
+        self._upgrade_meta_indexes()
+        if reloaded and 'meta_length' in self.tables:
+            self._update_meta_length(reloaded)
+
+        for name in [name for name in self._signatures if name not in on_disk]:
+            self._signatures.pop(name)
+            if name in self.tables:
+                self.tables.pop(name)
+                delattr(self, name)
+        self._replay()
+
+    def _load_table(self, name, path=None):
+        '''
+        Load a single table, unless its file has not changed since it was last loaded or saved.
+        Returns True if the table was loaded.
+        '''
+        if path is None:
+            path = self.savedir
+        filename = f'{path}/{name}.pkl'
+        signature = self._signature(filename)
+        # skip the table if it is up to date
+        if name in self.tables and self._signatures.get(name) == signature:
+            return False
+        f = open(filename, 'rb')
+        tmp_dict = pickle.load(f)
+        f.close()
+        self.tables.update({name: tmp_dict})
+        setattr(self, name, self.tables[name])
+        self._signatures[name] = signature
+        return True
+
+    def _upgrade_meta_indexes(self):
+        '''
+        Add the columns introduced after a db was created to its meta_indexes table.
+        Indexes of older dbs were always created on the primary key, with b=3.
+        '''
+        meta = self.tables.get('meta_indexes')
+        if meta is None or meta.column_names == META_INDEXES_COLUMNS:
+            return
+        rows = []
+        for row in meta.data:
+            if row[0] is None:
+                continue
+            defaults = {'index_type': 'Btree', 'b': 3, 'page_size': 0, 'include': []}
+            if 'column_name' not in meta.column_names:
+                table = self.tables[row[0]]
+                defaults['column_name'] = table.column_names[table.pk_idx]
+            rows.append([row[meta.column_names.index(col)] if col in meta.column_names else defaults[col] for col in META_INDEXES_COLUMNS])
+        self.tables['meta_indexes'] = Table(name='meta_indexes', column_names=META_INDEXES_COLUMNS, column_types=META_INDEXES_TYPES)
+        self.tables['meta_indexes']._insert_many(rows)
+        setattr(self, 'meta_indexes', self.tables['meta_indexes'])
+
+    #### WRITE-AHEAD LOG ####
+
+    # A statement that changes some rows of a table appends a single record to the log (the new values of the rows,
+    # see _commit) instead of saving the table. Every load applies the records that other writers have appended
+    # since its last one (_replay), and save is a checkpoint: it saves the changed tables and empties the log.
+    # Records are only appended under an S lock of the log. Checkpoints and the functions that change the schema
+    # of a table (or all its rows) X lock it, so they never run in the middle of a statement.
+
+    @contextmanager
+    def _log_lock(self, mode):
+        '''
+        Lock the write-ahead log (S or X) for the duration of a with block.
+        '''
+        self._locks.lock('meta_wal', mode, self.lock_timeout)
+        try:
+            yield
+        finally:
+            self._locks.unlock('meta_wal')
+
+    def _replay(self):
+        '''
+        Apply the records of the write-ahead log that are not part of the tables in memory yet. The log needs to be locked.
+        '''
+        generation, offset = self._wal_position
+        skip_own = True
+        if generation != self._wal.generation():
+            # a checkpoint has emptied the log since the last load (and the tables it saved have just been loaded),
+            # so every record of the log is new, even the ones we appended since
+            generation, offset = self._wal.generation(), 0
+            self._unindexed = {}
+            skip_own = False
+        records, offset = self._wal.read(offset)
+        self._wal_position = (generation, offset)
+        applied = False
+        for record in records:
+            applied |= self._apply(record, skip_own)
+        if applied:
+            self._update()
+
+    def _apply(self, record, skip_own=True):
+        '''
+        Apply a record of the write-ahead log to the tables in memory. Returns True if a table was changed.
+
+        record -> ('rows', writer, seq, pid, table_name, [(row, values)], insert_stack, indexed) for the changes of a
+                  statement (insert_stack is None if it did not change) or ('indexed', writer, seq) once they have
+                  reached the indexes of the table
+        skip_own -> If True, the records appended by this object are skipped (they are already applied). Def: True
+        '''
+        kind, writer, seq = record[:3]
+        if kind == 'indexed':
+            self._unindexed.pop((writer, seq), None)
+            return False
+        if skip_own and writer == self._wal_writer:
+            return False
+        pid, table_name, rows, insert_stack, indexed = record[3:]
+        table = self.tables.get(table_name)
+        if table is None:  # dropped since
+            return False
+        no_of_rows = 0
+        for row_idx, row in rows:
+            if row_idx < len(table.data):
+                no_of_rows -= any(value is not None for value in table.data[row_idx])
+                table._set_row(row_idx, row)
+            else:
+                table._append_row(row)
+            no_of_rows += any(value is not None for value in row)
+        self._add_to_meta_length(table_name, no_of_rows)
+        if insert_stack is not None:
+            self._update_meta_insert_stack_for_tb(table_name, insert_stack)
+        if indexed and writer != self._wal_writer:
+            self._unindexed[(writer, seq)] = (pid, table_name)
+        return True
+
+    def _commit(self, table_name, rows, insert_stack=None, old_values=None, log=True):
+        '''
+        Make the changes of a statement to rows of a table durable: they are appended to the write-ahead log as a
+        single record (the new values of the rows) and the indexes of the table are updated.
+        Changes to the meta tables are not logged, they are saved right away.
+
+        table_name -> table's name (needs to exist in database)
+        rows -> the positions of the changed rows
+        insert_stack -> the new insert_stack of the table. Def: None (unchanged)
+        old_values -> the values of the indexed columns in rows before the change (see _index_values). Def: None (empty rows)
+        log -> If False, the indexes and the insert_stack are updated but nothing is logged (the user saves). Def: True
+        '''
+        if insert_stack is not None:
+            self._update_meta_insert_stack_for_tb(table_name, insert_stack)
+        if not log:
+            self._update_indexes(table_name, rows, old_values)
+            return
+        if table_name[:4]=='meta':
+            self._update()
+            self.save()
+            return
+        table = self.tables[table_name]
+        indexed = self._has_index(table_name)
+        seq = next(self._wal_seq)
+        with self._log_lock('S'):
+            self._wal.append(('rows', self._wal_writer, seq, os.getpid(), table_name,
+                              [(row, list(table.data[row])) for row in rows], insert_stack, indexed))
+            if indexed:
+                # writers of other pages of the table may be changing its indexes as well
+                with self._locks.latch(table_name):
+                    self._update_indexes(table_name, rows, old_values)
+                # if this record is lost in a crash, recovery rebuilds the indexes, so it is not waited for
+                self._wal.append(('indexed', self._wal_writer, seq), sync=False)
+
+    @contextmanager
+    def _discard_on_error(self, discard=True):
+        '''
+        If the with block (the _commit of a statement that has already changed the tables in memory) raises,
+        the tables in memory are discarded: the change may not have been logged, so it must not be saved by our
+        next checkpoint. The next load reads every table again from its file and replays the whole log, as it would
+        for a new Database object (our records get a new writer id, so the ones that never reached the indexes
+        are noticed like those of other writers).
+
+        discard -> If False, the tables are kept (ie the user loads and saves, see insert). Def: True
+        '''
+        try:
+            yield
+        except BaseException:
+            if discard:
+                for name in self.tables:
+                    delattr(self, name)
+                self.tables = {}
+                self._signatures = {}
+                self._index_cache = {}
+                self._wal_position = (None, 0)
+                self._wal_writer = os.urandom(8).hex()
+                self._unindexed = {}
+            raise
+
+    def _recover(self):
+        '''
+        Load has replayed the log. If a crash has left the log (or the indexes) incomplete, checkpoint: a record that
+        was cut short would hide the records appended after it and the indexes that missed a change are rebuilt.
+        '''
+        with self._log_lock('X'):
+            self.load(self.savedir)
+            if self._wal_position[1] < self._wal.size() or \
+                    any(not is_alive(pid) for pid, _ in self._unindexed.values()):
+                self.save()
+
+    def _indexes_match(self, table_name):
+        '''
+        Return True if the indexes of a table match its snapshot in memory (as it was last loaded): every loaded change
+        has reached them and no other writer has logged a change to the table since. Readers do not lock the table,
+        so a result that was read from an index is only valid if this is still True after the index was read.
+
+        table_name -> table's name (needs to exist in database)
+        '''
+        if any(name == table_name for _, name in self._unindexed.values()):
+            return False
+        generation, offset = self._wal_position
+        try:
+            self._locks.lock('meta_wal', 'S', 0)
+        except LockTimeout:
+            # the log is X locked (ie by a checkpoint), it can not be checked without waiting
+            return False
+        try:
+            if self._wal.generation() != generation:
+                return False
+            records, _ = self._wal.read(offset)
+        finally:
+            self._locks.unlock('meta_wal')
+        return not any(record[0] == 'rows' and record[4] == table_name and record[1] != self._wal_writer for record in records)
+
+    def _checkpoint_if_needed(self):
+        '''
+        Checkpoint (save) if the write-ahead log has grown past CHECKPOINT_SIZE bytes.
+        '''
+        if self._wal.size() > CHECKPOINT_SIZE:
+            self.save()
+
+    def _repair_indexes(self):
+        '''
+        Rebuild the indexes of the tables with logged changes that never reached them (their writer crashed in between).
+        The log needs to be X locked, so that no statement is updating indexes at the same time.
+        '''
+        for table_name in {table_name for _, table_name in self._unindexed.values()}:
+            if table_name in self.tables:
+                for index_name, column_name, index_type, b, include in self._table_indexes(table_name):
+                    self._construct_index(table_name, index_name, column_name, index_type, b, include)
+        self._unindexed = {}
 
     def drop_db(self):
         shutil.rmtree(self.savedir)
@@ -85,114 +453,211 @@ class Database:
         Update all the meta tables.
         '''
         self._update_meta_length()
-        self._update_meta_locks()
         self._update_meta_insert_stack()
 
 
-    def create_table(self, name=None, column_names=None, column_types=None, primary_key=None, load=None):
+    def create_table(self, name=None, column_names=None, column_types=None, primary_key=None, load=None, storage='row'):
         '''
         This method create a new table. This table is saved and can be accessed by
         db_object.tables['table_name']
         or
         db_object.table_name
+
+        storage -> 'row' or 'columnar' (typed column buffers, see Table). Def: 'row'
         '''
-        self.tables.update({name: Table(name=name, column_names=column_names, column_types=column_types, primary_key=primary_key, load=load)})
-        # self._name = Table(name=name, column_names=column_names, column_types=column_types, load=load)
-        # check that new dynamic var doesnt exist already
-        if name not in self.__dir__():
-            setattr(self, name, self.tables[name])
-        else:
-            raise Exception(f'Attribute "{name}" already exists in class "{self.__class__.__name__}".')
-        # self.no_of_tables += 1
-        print(f'New table "{name}"')
-        self._update()
-        self.save()
+        with self._log_lock('X'):
+            self.load(self.savedir)
+            self.tables.update({name: Table(name=name, column_names=column_names, column_types=column_types, primary_key=primary_key, load=load, storage=storage)})
+            # self._name = Table(name=name, column_names=column_names, column_types=column_types, load=load)
+            # check that new dynamic var doesnt exist already
+            if name not in self.__dir__():
+                setattr(self, name, self.tables[name])
+            else:
+                raise Exception(f'Attribute "{name}" already exists in class "{self.__class__.__name__}".')
+            # self.no_of_tables += 1
+            print(f'New table "{name}"')
+            self._update()
+            self.save()
 
 
     def drop_table(self, table_name):
         '''
         Drop table with name 'table_name' from current db
         '''
-        self.load(self.savedir)
-        if self.is_locked(table_name):
-            return
-
-        self.tables.pop(table_name)
-        delattr(self, table_name)
-        if os.path.isfile(f'{self.savedir}/{table_name}.pkl'):
-            os.remove(f'{self.savedir}/{table_name}.pkl')
-        else:
-            print(f'"{self.savedir}/{table_name}.pkl" does not exist.')
-        self.delete('meta_locks', f'table_name=={table_name}')
-        self.delete('meta_length', f'table_name=={table_name}')
-        self.delete('meta_insert_stack', f'table_name=={table_name}')
-
-        # self._update()
-        self.save()
+        self.lockX_table(table_name)
+        try:
+            with self._log_lock('X'):
+                self.load(self.savedir)
+                self.tables.pop(table_name)
+                delattr(self, table_name)
+                if os.path.isfile(f'{self.savedir}/{table_name}.pkl'):
+                    os.remove(f'{self.savedir}/{table_name}.pkl')
+                else:
+                    print(f'"{self.savedir}/{table_name}.pkl" does not exist.')
+                self.delete('meta_length', f'table_name=={table_name}')
+                self.delete('meta_insert_stack', f'table_name=={table_name}')
+                # the indexes of the table are dropped with it
+                for index_name, _, index_type, _, _ in self._table_indexes(table_name):
+                    extension = 'hash' if index_type == 'Hash' else 'pkl'
+                    if os.path.isfile(f'{self.savedir}/indexes/meta_{index_name}_index.{extension}'):
+                        os.remove(f'{self.savedir}/indexes/meta_{index_name}_index.{extension}')
+                    self._index_cache.pop(index_name, None)
+                self.delete('meta_indexes', f'table_name=={table_name}')
+
+                # self._update()
+                self.save()
+        finally:
+            self.unlock_table(table_name)
 
 
-    def table_from_csv(self, filename, name=None, column_types=None, primary_key=None):
+    def table_from_csv(self, filename, name=None, column_types=None, primary_key=None, header=True, column_names=None,\
+                       delimiter=',', chunk_size=10000, on_error='raise', quarantine_file=None, progress=True):
         '''
         Create a table from a csv file.
         If name is not specified, filename's name is used
         If column types are not specified, all are regarded to be of type str
+
+        The file is streamed: it is read and inserted chunk_size rows at a time, so only one chunk is in memory.
+
+        header -> If True, the first line of the file contains the column names. Def: True
+        column_names -> The column names of the table. Needed if header is False. If header is True, they replace the file's ones.
+        delimiter -> The character that separates the values of a line. Def: ','
+        chunk_size -> The number of lines that will be read and inserted at a time. Def: 10000
+        on_error -> What to do with a line that can not be inserted (not castable, wrong number of values, duplicate primary key):
+                    'raise' (abort the import and drop the table, so nothing is imported), 'skip' (ignore the line)
+                    or 'quarantine' (write the line to quarantine_file). Def: 'raise'
+        quarantine_file -> The csv file that the rejected lines are written to, along with the error. Def: None ('<name>_rejected.csv')
+        progress -> If True, print the number of imported lines after every chunk. Def: True
         '''
+        if on_error not in ['raise', 'skip', 'quarantine']:
+            raise ValueError(f'on_error should be one of "raise", "skip" or "quarantine", not "{on_error}".')
+
         if name is None:
             name=filename.split('.')[:-1][0]
 
+        # the import is saved at its end, so the log stays X locked (no other change can be logged) until then
+        with self._log_lock('X'), open(filename, 'r', newline='') as file:
+            reader = csv.reader(file, delimiter=delimiter)
+
+            if header:
+                file_column_names = next(reader)
+                if column_names is None:
+                    column_names = file_column_names
+            elif column_names is None:
+                raise ValueError('column_names need to be specified if the file has no header.')
+
+            if column_types is None:
+                column_types = [str for _ in column_names]
+            self.create_table(name=name, column_names=column_names, column_types=column_types, primary_key=primary_key)
+            self.lockX_table(name)
+
+            quarantine = None
+            if on_error == 'quarantine':
+                if quarantine_file is None:
+                    quarantine_file = f'{name}_rejected.csv'
+                quarantine = open(quarantine_file, 'w', newline='')
+                quarantine_writer = csv.writer(quarantine, delimiter=delimiter)
+
+            no_of_rows = 0
+            no_of_rejected = 0
+            try:
+                while True:
+                    chunk = list(islice(reader, chunk_size))
+                    if not chunk:
+                        break
+                    try:
+                        # the whole chunk is casted and inserted in one go
+                        self.tables[name]._insert_many(chunk)
+                        no_of_rows += len(chunk)
+                    except ValueError:
+                        if on_error == 'raise':
+                            raise
+                        # a line of the chunk is not valid. Insert the lines one by one to find it (and the others)
+                        for row in chunk:
+                            try:
+                                # _insert casts the values in place, a copy keeps the line as it was read
+                                self.tables[name]._insert(list(row))
+                                no_of_rows += 1
+                            except ValueError as e:
+                                no_of_rejected += 1
+                                if quarantine is not None:
+                                    quarantine_writer.writerow(row+[str(e)])
+                    if progress:
+                        print(f'{name}: {no_of_rows} rows imported, {no_of_rejected} rejected')
+            except:
+                # the import is all or nothing, the chunks imported before the error are dropped with the table
+                self.drop_table(name)
+                raise
+            finally:
+                if quarantine is not None:
+                    quarantine.close()
+                self.unlock_table(name)
 
-        file = open(filename, 'r')
-
-        first_line=True
-        for line in file.readlines():
-            if first_line:
-                colnames = line.strip('\n').split(',')
-                if column_types is None:
-                    column_types = [str for _ in colnames]
-                self.create_table(name=name, column_names=colnames, column_types=column_types, primary_key=primary_key)
-                self.lockX_table(name)
-                first_line = False
-                continue
-            self.tables[name]._insert(line.strip('\n').split(','))
+            self._update()
+            self._update_meta_length([name])
+            self.save()
 
-        self.unlock_table(name)
-        self._update()
-        self.save()
 
+    def table_to_csv(self, table_name, filename=None, columns='*', condition=None, order_by=None, asc=False,\
+                     delimiter=',', header=True, compress=False):
+        '''
+        Export a table (or the result of a select on it) to a csv file.
+        The rows are streamed to the file one by one, deleted rows are skipped.
 
-    def table_to_csv(self, table_name, filename=None):
-        res = ''
-        for row in [self.tables[table_name].column_names]+self.tables[table_name].data:
-            res+=str(row)[1:-1].replace('\'', '').replace('"','').replace(' ','')+'\n'
+        table_name -> table's name (needs to exist in database)
+        filename -> The name of the output file. Def: None ('<table_name>.csv', or '<table_name>.csv.gz' if compress is True)
+        columns, condition, order_by, asc -> same as in select
+        delimiter -> The character that separates the values of a line. Def: ','
+        header -> If True, the column names are written in the first line. Def: True
+        compress -> If True, the output is gzipped. Def: False
+        '''
+        table = self.tables[table_name]
 
         if filename is None:
-            filename = f'{table_name}.csv'
+            filename = f'{table_name}.csv.gz' if compress else f'{table_name}.csv'
+
+        if compress:
+            file = gzip.open(filename, 'wt', newline='')
+        else:
+            file = open(filename, 'w', newline='')
 
-        with open(filename, 'w') as file:
-           file.write(res)
+        with file:
+            writer = csv.writer(file, delimiter=delimiter)
+            if header:
+                writer.writerow(table.column_names if columns == '*' else columns)
+            writer.writerows(table._iter_where(columns, condition, order_by, asc))
 
     def table_from_object(self, new_table):
         '''
         Add table obj to database.
         '''
-
-        self.tables.update({new_table._name: new_table})
-        if new_table._name not in self.__dir__():
-            setattr(self, new_table._name, new_table)
-        else:
-            raise Exception(f'"{new_table._name}" attribute already exists in class "{self.__class__.__name__}".')
-        self._update()
-        self.save()
+        with self._log_lock('X'):
+            self.load(self.savedir)
+            self.tables.update({new_table._name: new_table})
+            new_table._dirty = True
+            if new_table._name not in self.__dir__():
+                setattr(self, new_table._name, new_table)
+            else:
+                raise Exception(f'"{new_table._name}" attribute already exists in class "{self.__class__.__name__}".')
+            self._update()
+            self.save()
 
 
 
     ##### table functions #####
 
-    # In every table function a load command is executed to fetch the most recent table.
-    # In every table function, we first check whether the table is locked. Since we have implemented
-    # only the X lock, if the tables is locked we always abort.
-    # After every table function, we update and save. Update updates all the meta tables and save saves all
-    # tables.
+    # Every function that changes a table first locks it (an exclusive (X) lock, or S and X locks on pages of rows
+    # for updates). If the table is locked by someone else with a conflicting lock, we wait for it (in FIFO order)
+    # for up to lock_timeout seconds and then raise LockTimeout.
+    # Readers (select, show_table, inner_join) do not lock: they read a snapshot of the committed changes.
+    # They do not wait for checkpoints either, if the log is X locked they read the snapshot they already have.
+    # Then a load command is executed to fetch the most recent table (after locking, so that a holder we waited for
+    # is not missed). Load only reads the tables whose file has changed since we last loaded/saved them and the new
+    # records of the write-ahead log, so a Database object can be kept around as a long lived session without
+    # paying for a full reload every time.
+    # A function that changes rows of a table appends them to the write-ahead log (_commit) before it releases
+    # the lock, so the next holder loads them. The tables are saved at checkpoints, when the log grows too long.
+    # Functions that change a whole table (sort, cast_column) X lock the log and save right away.
 
     # these function calls are named close to the ones in postgres
 
@@ -205,14 +670,19 @@ class Database:
         column_name -> the column that will be casted (needs to exist in table)
         cast_type -> needs to be a python type like str int etc. NOT in ''
         '''
-        self.load(self.savedir)
-        if self.is_locked(table_name):
-            return
         self.lockX_table(table_name)
-        self.tables[table_name]._cast_column(column_name, cast_type)
-        self.unlock_table(table_name)
-        self._update()
-        self.save()
+        try:
+            with self._log_lock('X'):
+                self.load(self.savedir)
+                self.tables[table_name]._cast_column(column_name, cast_type)
+                # the indexes on (or including) the column hold the old values, they are rebuilt like in sort
+                for index_name, indexed_column, index_type, b, include in self._table_indexes(table_name):
+                    if column_name == indexed_column or column_name in include:
+                        self._construct_index(table_name, index_name, indexed_column, index_type, b, include)
+                self._update()
+                self.save()
+        finally:
+            self.unlock_table(table_name)
 
     def insert(self, table_name, row, lock_load_save=True):
         '''
@@ -223,25 +693,68 @@ class Database:
         lock_load_save -> If false, user need to load, lock and save the states of the database (CAUTION). Usefull for bulk loading
         '''
         if lock_load_save:
-            self.load(self.savedir)
-            if self.is_locked(table_name):
-                return
-            # fetch the insert_stack. For more info on the insert_stack
-            # check the insert_stack meta table
             self.lockX_table(table_name)
-        insert_stack = self._get_insert_stack_for_table(table_name)
         try:
-            self.tables[table_name]._insert(row, insert_stack)
-        except Exception as e:
-            print(e)
-            print('ABORTED')
-        # sleep(2)
-        self._update_meta_insert_stack_for_tb(table_name, insert_stack[:-1])
+            if lock_load_save:
+                self.load(self.savedir)
+            insert_stack = self._get_insert_stack_for_table(table_name)
+            try:
+                self.tables[table_name]._insert(row, insert_stack)
+            except Exception as e:
+                print(e)
+                print('ABORTED')
+            else:
+                self._add_to_meta_length(table_name, 1)
+                with self._discard_on_error(lock_load_save):
+                    # the last slot of the insert_stack (if any) has been used
+                    if insert_stack != []:
+                        self._commit(table_name, [insert_stack[-1]], insert_stack[:-1], log=lock_load_save)
+                    else:
+                        self._commit(table_name, [len(self.tables[table_name].data)-1], log=lock_load_save)
+            # sleep(2)
+            if lock_load_save:
+                self._update()
+        finally:
+            if lock_load_save:
+                self.unlock_table(table_name)
         if lock_load_save:
-            self.unlock_table(table_name)
-            self._update()
-            self.save()
+            self._checkpoint_if_needed()
+
+
+    def insert_many(self, table_name, rows, lock_load_save=True):
+        '''
+        Inserts a list of rows into table. The rows are validated, casted and inserted in one go,
+        with a single lock/load/save cycle. If one of the rows is not valid, none of them is inserted.
 
+        table_name -> table's name (needs to exist in database)
+        rows -> a list of rows. Each row is a list of the values that are going to be inserted (will be automatically casted to predifined type)
+        lock_load_save -> If false, user need to load, lock and save the states of the database (CAUTION).
+        '''
+        if lock_load_save:
+            self.lockX_table(table_name)
+        try:
+            if lock_load_save:
+                self.load(self.savedir)
+            insert_stack = self._get_insert_stack_for_table(table_name)
+            no_of_rows = len(self.tables[table_name].data)
+            try:
+                new_stack = self.tables[table_name]._insert_many(rows, insert_stack)
+            except Exception as e:
+                print(e)
+                print('ABORTED')
+            else:
+                self._add_to_meta_length(table_name, len(rows))
+                with self._discard_on_error(lock_load_save):
+                    # the rows went to the used slots of the insert_stack and to the end of the table
+                    self._commit(table_name, insert_stack[len(new_stack):] + list(range(no_of_rows, len(self.tables[table_name].data))),
+                                 new_stack if new_stack != insert_stack else None, log=lock_load_save)
+            if lock_load_save:
+                self._update()
+        finally:
+            if lock_load_save:
+                self.unlock_table(table_name)
+        if lock_load_save:
+            self._checkpoint_if_needed()
 
     def update(self, table_name, set_value, set_column, condition):
         '''
@@ -255,15 +768,33 @@ class Database:
                     'value[<,<=,==,>=,>]column'.
 
                     operatores supported -> (<,<=,==,>=,>)
+                    conditions can be combined with 'and' (ie 'column>=value and column<value'), and
+                    'column between value and value' is the same as 'column>=value and column<=value'.
         '''
-        self.load(self.savedir)
-        if self.is_locked(table_name):
-            return
-        self.lockX_table(table_name)
-        self.tables[table_name]._update_row(set_value, set_column, condition)
-        self.unlock_table(table_name)
-        self._update()
-        self.save()
+        if table_name not in self.tables:
+            self.load(self.savedir)
+        table = self.tables[table_name]
+        primary_key = table.column_names[table.pk_idx] if table.pk_idx is not None else None
+        # primary key values need to be unique in the whole table, so its updates lock the whole table
+        whole_table = table_name[:4]=='meta' or set_column == primary_key
+        if whole_table:
+            self.lockX_table(table_name)
+        else:
+            rows, _ = self._lock_rows(table_name, condition)
+        try:
+            if whole_table:
+                self.load(self.savedir)
+                rows = self.tables[table_name]._rows_where_condition(condition)
+            table = self.tables[table_name]
+            old_values = self._index_values(table_name, rows, [set_column])
+            table._update_rows(set_value, set_column, rows)
+            with self._discard_on_error():
+                self._commit(table_name, rows, old_values=old_values)
+            self._update()
+        finally:
+            self._locks.unlock_pages(table_name)
+            self.unlock_table(table_name)
+        self._checkpoint_if_needed()
 
     def delete(self, table_name, condition):
         '''
@@ -275,22 +806,28 @@ class Database:
                     'value[<,<=,==,>=,>]column'.
 
                     operatores supported -> (<,<=,==,>=,>)
+                    conditions can be combined with 'and' (ie 'column>=value and column<value'), and
+                    'column between value and value' is the same as 'column>=value and column<=value'.
         '''
-        self.load(self.savedir)
-        if self.is_locked(table_name):
-            return
         self.lockX_table(table_name)
-        deleted = self.tables[table_name]._delete_where(condition)
-        self.unlock_table(table_name)
-        self._update()
-        self.save()
-        # we need the save above to avoid loading the old database that still contains the deleted elements
-        if table_name[:4]!='meta':
-            self._add_to_insert_stack(table_name, deleted)
-        self.save()
+        try:
+            self.load(self.savedir)
+            table = self.tables[table_name]
+            rows = table._rows_where_condition(condition)
+            old_values = self._index_values(table_name, rows)
+            deleted = table._delete_rows(rows)
+            self._add_to_meta_length(table_name, -len(deleted))
+            # the deleted rows of a (non meta) table are emptied, their slots are reused by the next inserts
+            insert_stack = self._get_insert_stack_for_table(table_name) + deleted if table_name[:4]!='meta' else None
+            with self._discard_on_error():
+                self._commit(table_name, rows, insert_stack, old_values)
+            self._update()
+        finally:
+            self.unlock_table(table_name)
+        self._checkpoint_if_needed()
 
     def select(self, table_name, columns, condition=None, order_by=None, asc=False,\
-               top_k=None, save_as=None, return_object=False):
+               top_k=None, save_as=None, return_object=False, diagnostic=False):
         '''
         Selects and outputs a table's data where condtion is met.
 
@@ -301,26 +838,46 @@ class Database:
                     'value[<,<=,==,>=,>]column'.
 
                     operatores supported -> (<,<=,==,>=,>)
+                    conditions can be combined with 'and' (ie 'column>=value and column<value'), and
+                    'column between value and value' is the same as 'column>=value and column<=value'.
         order_by -> A column name that signals that the resulting table should be ordered based on it. Def: None (no ordering)
         asc -> If True order by will return results using an ascending order. Def: False
         top_k -> A number (int) that defines the number of rows that will be returned. Def: None (all rows)
         save_as -> The name that will be used to save the resulting table in the database. Def: None (no save)
         return_object -> If true, the result will be a table object (usefull for internal usage). Def: False (the result will be printed)
+        diagnostic -> If True and an index is used, the select is also run sequentially and both results are printed
+                      along with their number of comparison operations. Def: False
 
         '''
-        self.load(self.savedir)
-        if self.is_locked(table_name):
-            return
-        self.lockX_table(table_name)
-        if condition is not None:
-            condition_column = split_condition(condition)[0]
-        if self._has_index(table_name) and condition_column==self.tables[table_name].column_names[self.tables[table_name].pk_idx]:
-            index_name = self.select('meta_indexes', '*', f'table_name=={table_name}', return_object=True).index_name[0]
-            bt = self._load_idx(index_name)
-            table = self.tables[table_name]._select_where_with_btree(columns, bt, condition, order_by, asc, top_k)
-        else:
+        # selects do not lock the table. They read the tables in memory, a snapshot of the committed changes
+        # (load applies whole statements of the log). See _indexes_match for the indexes
+        self._load_snapshot([table_name])
+        # use an index on a column of the condition, if there is one (a hash index for ==, a btree for any operator).
+        # Equalities are the most selective conditions, so their columns are tried first
+        bt = None
+        covering = None
+        if condition is not None and table_name[:4]!='meta':
+            # a covering btree answers the select on its own, without reading the table
+            covering = self._covering_index(table_name, columns, condition, order_by)
+            if covering is None:
+                for condition_column, operator, _ in sorted(split_conditions(condition), key=lambda cond: cond[1] != '=='):
+                    bt = self._get_index(table_name, condition_column, operator)
+                    if bt is not None:
+                        break
+        table = None
+        try:
+            if covering is not None:
+                bt, condition_column = covering
+                table = self.tables[table_name]._select_where_from_index(columns, bt, condition, condition_column, order_by, asc, top_k)
+            elif bt is not None:
+                table = self.tables[table_name]._select_where_with_btree(columns, bt, condition, order_by, asc, top_k, diagnostic, condition_column)
+        finally:
+            # a hash index keeps its file open for lookups
+            if isinstance(bt, HashIndex):
+                bt.close()
+        # if a writer has changed the table (and its indexes) since the snapshot, the snapshot is scanned instead
+        if table is None or not self._indexes_match(table_name):
             table = self.tables[table_name]._select_where(columns, condition, order_by, asc, top_k)
-        self.unlock_table(table_name)
         if save_as is not None:
             table._name = save_as
             self.table_from_object(table)
@@ -336,10 +893,8 @@ class Database:
 
         table_name -> table's name (needs to exist in database)
         '''
-        self.load(self.savedir)
-        if self.is_locked(table_name):
-            return
-        self.tables[table_name].show(no_of_rows, self.is_locked(table_name))
+        self._load_snapshot([table_name])
+        self.tables[table_name].show(no_of_rows)
 
     def sort(self, table_name, column_name, asc=False):
         '''
@@ -349,17 +904,25 @@ class Database:
         column_name -> the column that will be used to sort
         asc -> If True sort will return results using an ascending order. Def: False
         '''
-
-        self.load(self.savedir)
-        if self.is_locked(table_name):
-            return
         self.lockX_table(table_name)
-        self.tables[table_name]._sort(column_name, asc=asc)
-        self.unlock_table(table_name)
-        self._update()
-        self.save()
+        try:
+            with self._log_lock('X'):
+                self.load(self.savedir)
+                self.tables[table_name]._sort(column_name, asc=asc)
+                # every row may have moved, so the indexes are rebuilt (bulk loaded) and the insert_stack
+                # has to point to the new positions of the deleted rows (they are sorted last)
+                for index_name, indexed_column, index_type, b, include in self._table_indexes(table_name):
+                    self._construct_index(table_name, index_name, indexed_column, index_type, b, include)
+                if table_name[:4]!='meta':
+                    data = self.tables[table_name].data
+                    self._update_meta_insert_stack_for_tb(table_name, [i for i, row in enumerate(data) if all(value is None for value in row)])
+                self._update()
+                self._update_meta_length([table_name])
+                self.save()
+        finally:
+            self.unlock_table(table_name)
 
-    def inner_join(self, left_table_name, right_table_name, condition, save_as=None, return_object=False):
+    def inner_join(self, left_table_name, right_table_name, condition, save_as=None, return_object=False, algorithm=None):
         '''
         Join two tables that are part of the database where condition is met.
         left_table_name -> left table's name (needs to exist in database)
@@ -371,13 +934,25 @@ class Database:
                     operatores supported -> (<,<=,==,>=,>)
         save_as -> The name that will be used to save the resulting table in the database. Def: None (no save)
         return_object -> If true, the result will be a table object (usefull for internal usage). Def: False (the result will be printed)
+        algorithm -> 'index', 'hash' (only for ==), 'sort_merge' or 'nested_loop'.
+                     Def: None (index if the join column of the right table is indexed, else chosen based on the operator)
         '''
-        self.load(self.savedir)
-        if self.is_locked(left_table_name) or self.is_locked(right_table_name):
-            print(f'Table/Tables are currently locked')
-            return
+        # like select, joins read a snapshot and do not lock the tables
+        self._load_snapshot([left_table_name, right_table_name])
 
-        res = self.tables[left_table_name]._inner_join(self.tables[right_table_name], condition)
+        # if the join column of the right table is indexed, the index can be probed instead of scanning the table
+        index = None
+        if algorithm in [None, 'index']:
+            _, operator, column_name_right = split_condition(condition)
+            index = self._get_index(right_table_name, column_name_right, operator)
+
+        try:
+            res = self.tables[left_table_name]._inner_join(self.tables[right_table_name], condition, algorithm, index)
+        finally:
+            if isinstance(index, HashIndex):
+                index.close()
+        if index is not None and not self._indexes_match(right_table_name):
+            res = self.tables[left_table_name]._inner_join(self.tables[right_table_name], condition, None if algorithm == 'index' else algorithm)
         if save_as is not None:
             res._name = save_as
             self.table_from_object(res)
@@ -387,84 +962,171 @@ class Database:
             else:
                 res.show()
 
-    def lockX_table(self, table_name):
+    def _lock_rows(self, table_name, condition):
         '''
-        Locks the specified table using the exclusive lock (X)
+        Lock the rows of a table where condition is met (for an update). Returns their positions and
+        whether the whole table was locked instead.
+        The table is S locked, so that no writer of the whole table can run at the same time, and the pages of
+        the rows (ROWS_PER_PAGE consecutive rows) are X locked. If the rows are on more than LOCK_ESCALATION
+        pages, the table is X locked instead.
 
         table_name -> table's name (needs to exist in database)
+        condition -> the condition of the update
         '''
-        if table_name[:4]=='meta':
-            return
+        # on any error (ie a lock timeout or an invalid condition) the locks taken here are released
+        if self._locks.holds(table_name, 'X'):
+            # the whole table is already locked (ie with lockX_table)
+            self.lockX_table(table_name)
+            try:
+                return self.tables[table_name]._rows_where_condition(condition), True
+            except BaseException:
+                self.unlock_table(table_name)
+                raise
+
+        self.lockS_table(table_name)
+        pages = set()
+        try:
+            self.load(self.savedir)
+            while True:
+                rows = self.tables[table_name]._rows_where_condition(condition)
+                new_pages = {row // ROWS_PER_PAGE for row in rows} - pages
+                if not new_pages:
+                    return rows, False
+                if len(pages) + len(new_pages) > LOCK_ESCALATION:
+                    break
+                if pages and min(new_pages) < max(pages):
+                    # waiting for a page below one we hold would break the ascending order the pages are locked in
+                    # (two writers could wait for each other), so all of them are released and locked again in order
+                    self._locks.unlock_pages(table_name)
+                    new_pages |= pages
+                    pages = set()
+                self._locks.lock_pages(table_name, new_pages, self.lock_timeout)
+                pages |= new_pages
+                # a writer we waited for may have changed the rows
+                self.load(self.savedir)
+        except BaseException:
+            self._locks.unlock_pages(table_name)
+            self.unlock_table(table_name)
+            raise
+
+        # lock escalation
+        self._locks.unlock_pages(table_name)
+        self.unlock_table(table_name)
+        self.lockX_table(table_name)
+        try:
+            self.load(self.savedir)
+            return self.tables[table_name]._rows_where_condition(condition), True
+        except BaseException:
+            self.unlock_table(table_name)
+            raise
+
+    def lockX_table(self, table_name, timeout=None):
+        '''
+        Locks the specified table using the exclusive lock (X). If the table is locked by someone else,
+        waits for it and raises LockTimeout if it is not released in time.
+
+        table_name -> table's name (needs to exist in database)
+        timeout -> the number of seconds to wait. Def: None (the lock_timeout of the database)
+        '''
+        return self._lock_table(table_name, 'X', timeout)
+
+    def lockS_table(self, table_name, timeout=None):
+        '''
+        Locks the specified table using the shared lock (S). Any number of readers can hold it at the same time,
+        but not while the table is X locked. If the table is X locked by someone else, waits for it
+        and raises LockTimeout if it is not released in time.
+
+        table_name -> table's name (needs to exist in database)
+        timeout -> the number of seconds to wait. Def: None (the lock_timeout of the database)
+        '''
+        return self._lock_table(table_name, 'S', timeout)
 
-        self.tables['meta_locks']._update_row(True, 'locked', f'table_name=={table_name}')
-        self._save_locks()
-        # print(f'Locking table "{table_name}"')
+    def _lock_table(self, table_name, mode, timeout=None):
+        if table_name[:4]=='meta':  # meta tables will never be locked (they are internal)
+            return True
+        return self._locks.lock(table_name, mode, self.lock_timeout if timeout is None else timeout)
 
     def unlock_table(self, table_name):
         '''
-        Unlocks the specified table that is exclusivelly locked (X)
+        Unlocks the specified table (releases a lock taken with lockX_table or lockS_table)
 
         table_name -> table's name (needs to exist in database)
         '''
-        self.tables['meta_locks']._update_row(False, 'locked', f'table_name=={table_name}')
-        self._save_locks()
-        # print(f'Unlocking table "{table_name}"')
+        self._locks.unlock(table_name)
 
     def is_locked(self, table_name):
         '''
-        Check whether the specified table is exclusivelly locked (X)
+        Check whether the specified table is exclusivelly locked (X) by someone else
 
         table_name -> table's name (needs to exist in database)
         '''
         if table_name[:4]=='meta':  # meta tables will never be locked (they are internal)
             return False
 
-        with open(f'{self.savedir}/meta_locks.pkl', 'rb') as f:
-            self.tables.update({'meta_locks': pickle.load(f)})
-            self.meta_locks = self.tables['meta_locks']
+        res = self._locks.is_locked(table_name, 'S')
+        if res:
+            print(f'Table "{table_name}" is currently locked.')
+        return res
 
-        try:
-            res = self.select('meta_locks', ['locked'], f'table_name=={table_name}', return_object=True).locked[0]
-            if res:
-                print(f'Table "{table_name}" is currently locked.')
-            return res
+    def lock_waits(self, return_object=False):
+        '''
+        Show (or return) the lock waits of this database object per table: the number of waits (lock requests
+        that found the table locked), how many of them timed out and the total and longest time waited (in seconds).
+        The tables with the most waiting are shown first.
 
-        except IndexError:
-            return
+        return_object -> If true, the result will be a table object (usefull for internal usage). Def: False (the result will be printed)
+        '''
+        res = Table(name='lock_waits', column_names=['table_name', 'waits', 'timeouts', 'total_wait', 'max_wait'],
+                    column_types=[str, int, int, float, float])
+        res._insert_many([[table_name]+stats for table_name, stats in self._locks.wait_stats.items()])
+        res = res.order_by('total_wait')
+        if return_object:
+            return res
+        res.show()
 
     #### META ####
 
     # The following functions are used to update, alter, load and save the meta tables.
     # Important: Meta tables contain info regarding the NON meta tables ONLY.
-    # i.e. meta_length will not show the number of rows in meta_locks etc.
+    # i.e. meta_length will not show the number of rows in meta_insert_stack etc.
 
-    def _update_meta_length(self):
+    def _update_meta_length(self, table_names=()):
         '''
-        updates the meta_length table.
+        updates the meta_length table. New tables are added with their number of rows. The number of rows of the
+        other tables is kept up to date by the table functions (see _add_to_meta_length), so they are only
+        counted again if they are in table_names.
+
+        table_names -> the tables whose rows will be counted again. Def: () (only the new tables)
         '''
+        meta = self.tables['meta_length']
         for table in self.tables.values():
             if table._name[:4]=='meta': #skip meta tables
                 continue
-            if table._name not in self.meta_length.table_name: # if new table, add record with 0 no. of rows
-                self.tables['meta_length']._insert([table._name, 0])
+            if table._name not in meta.table_name: # if new table, add record with 0 no. of rows
+                meta._insert([table._name, 0])
+            elif table._name not in table_names:
+                continue
 
             # the result needs to represent the rows that contain data. Since we use an insert_stack
             # some rows are filled with Nones. We skip these rows.
-            non_none_rows = len([row for row in table.data if any(row)])
-            self.tables['meta_length']._update_row(non_none_rows, 'no_of_rows', f'table_name=={table._name}')
-            # self.update_row('meta_length', len(table.data), 'no_of_rows', 'table_name', '==', table._name)
+            non_none_rows = sum(1 for row in table.data if any(value is not None for value in row))
+            # only touch the record if the number has changed, so that meta_length is not needlessly saved
+            row_idx = meta.table_name.index(table._name)
+            if meta.no_of_rows[row_idx] != non_none_rows:
+                meta._set_cell(row_idx, meta.column_names.index('no_of_rows'), non_none_rows)
 
-    def _update_meta_locks(self):
-        '''
-        updates the meta_locks table
+    def _add_to_meta_length(self, table_name, no_of_rows):
         '''
-        for table in self.tables.values():
-            if table._name[:4]=='meta': #skip meta tables
-                continue
-            if table._name not in self.meta_locks.table_name:
+        Add no_of_rows (negative for deleted rows) to the number of rows of a table in the meta_length table.
 
-                self.tables['meta_locks']._insert([table._name, False])
-                # self.insert('meta_locks', [table._name, False])
+        table_name -> table's name (needs to exist in database)
+        no_of_rows -> the number of inserted rows minus the number of deleted ones
+        '''
+        meta = self.tables['meta_length']
+        if table_name[:4]=='meta' or not no_of_rows or table_name not in meta.table_name:
+            return
+        row_idx = meta.table_name.index(table_name)
+        meta._set_cell(row_idx, meta.column_names.index('no_of_rows'), meta.no_of_rows[row_idx] + no_of_rows)
 
     def _update_meta_insert_stack(self):
         '''
@@ -508,76 +1170,301 @@ class Database:
 
 
     # indexes
-    def create_index(self, table_name, index_name, index_type='Btree'):
+    def create_index(self, table_name, index_name, index_type='Btree', b=None, page_size=4096, column_name=None, include=None):
         '''
         Create an index on a specified table with a given name.
-        Important: An index can only be created on a primary key. Thus the user does not specify the column
+        An index on the primary key maps every value to a single row. An index on any other column keeps
+        a list of rows (posting list) for every value.
 
         table_name -> table's name (needs to exist in database)
         index_name -> name of the created index
+        index_type -> 'Btree' (any condition) or 'Hash' (== only, a single probe per lookup). Def: 'Btree'
+        b -> the branching factor of the btree. Def: None (sized so that a node fits in page_size bytes)
+        page_size -> the byte budget of a node, used if b is None. Def: 4096
+        column_name -> the indexed column. Def: None (the primary key)
+        include -> a list of columns whose values are also stored in the leaves of the btree (a covering index).
+                   Selects that only need the indexed and the included columns are answered by the index alone. Def: None
         '''
-        if self.tables[table_name].pk_idx is None: # if no primary key, no index
-            print('## ERROR - Cant create index. Table has no primary key.')
-            return
-        if index_name not in self.tables['meta_indexes'].index_name:
-            # currently only btree is supported. This can be changed by adding another if.
-            if index_type=='Btree':
-                print('Creating Btree index.')
-                # insert a record with the name of the index and the table on which it's created to the meta_indexes table
-                self.tables['meta_indexes']._insert([table_name, index_name])
-                # crate the actual index
-                self._construct_index(table_name, index_name)
-                self.save()
-        else:
-            print('## ERROR - Cant create index. Another index with the same name already exists.')
-            return
+        # the index is built from the table, so no row of it may change (or be logged) in the meantime
+        self.lockX_table(table_name)
+        try:
+            with self._log_lock('X'):
+                self.load(self.savedir)
+                table = self.tables[table_name]
+                if column_name is None:
+                    if table.pk_idx is None: # if no primary key and no column, no index
+                        print('## ERROR - Cant create index. Table has no primary key, specify the column to index.')
+                        return
+                    column_name = table.column_names[table.pk_idx]
+                if column_name not in table.column_names:
+                    print(f'## ERROR - Cant create index. Column "{column_name}" does not exist.')
+                    return
+                if index_type not in ['Btree', 'Hash']:
+                    print(f'## ERROR - Cant create index. Index type should be "Btree" or "Hash", not "{index_type}".')
+                    return
+                if self._index_name(table_name, column_name, index_type) is not None:
+                    print(f'## ERROR - Cant create index. Column "{column_name}" already has a {index_type} index.')
+                    return
+                include = list(include) if include is not None else []
+                if include and index_type != 'Btree':
+                    print('## ERROR - Cant create index. Only a Btree index can include columns.')
+                    return
+                for included_column in include:
+                    if included_column not in table.column_names or included_column == column_name:
+                        print(f'## ERROR - Cant create index. Column "{included_column}" can not be included.')
+                        return
+                if index_name not in self.tables['meta_indexes'].index_name:
+                    if index_type=='Btree':
+                        if b is None:
+                            b = self._branching_factor(table_name, column_name, page_size)
+                        else:
+                            page_size = 0
+                        if b < 3:
+                            print('## ERROR - Cant create index. The branching factor should be at least 3.')
+                            return
+                        print(f'Creating Btree index (b={b}).')
+                        # insert a record with the name of the index, the table on which it's created and its parameters to the meta_indexes table
+                        self.tables['meta_indexes']._insert([table_name, index_name, column_name, index_type, b, page_size, include])
+                        # crate the actual index
+                        self._construct_index(table_name, index_name, column_name, index_type, b, include)
+                        self.save()
+                    elif index_type=='Hash':
+                        print('Creating Hash index.')
+                        self.tables['meta_indexes']._insert([table_name, index_name, column_name, index_type, 0, 0, []])
+                        self._construct_index(table_name, index_name, column_name, index_type)
+                        self.save()
+                else:
+                    print('## ERROR - Cant create index. Another index with the same name already exists.')
+                    return
+        finally:
+            self.unlock_table(table_name)
 
-    def _construct_index(self, table_name, index_name):
+    def _construct_index(self, table_name, index_name, column_name, index_type='Btree', b=3, include=()):
         '''
-        Construct a btree on a table and save.
+        Construct an index on a table's column and save.
 
         table_name -> table's name (needs to exist in database)
         index_name -> name of the created index
+        column_name -> the indexed column
+        index_type -> 'Btree' or 'Hash'
+        b -> the branching factor of the btree
+        include -> the columns stored in the leaves of the btree
         '''
-        bt = Btree(3) # 3 is arbitrary
-
-        # for each record in the primary key of the table, insert its value and index to the btree
-        for idx, key in enumerate(self.tables[table_name].columns[self.tables[table_name].pk_idx]):
-            bt.insert(key, idx)
+        table = self.tables[table_name]
+        column_idx = table.column_names.index(column_name)
+        # only the primary key is unique, the other columns need posting lists
+        if index_type == 'Hash':
+            bt = HashIndex(unique=column_idx==table.pk_idx)
+        else:
+            bt = Btree(b, unique=column_idx==table.pk_idx, include=include)
+
+        # bulk load the (value, index) pairs of the column (skipping deleted rows) to the btree
+        column = table.columns[column_idx]
+        if include:
+            # along with the values of the included columns
+            included = list(zip(*[table.columns[table.column_names.index(name)] for name in include]))
+            bt.bulk_load((key, idx, included[idx]) for idx, key in enumerate(column) if key is not None)
+        else:
+            bt.bulk_load((key, idx) for idx, key in enumerate(column) if key is not None)
         # save the btree
         self._save_index(index_name, bt)
 
 
+    def _branching_factor(self, table_name, column_name, page_size, sample_size=1000):
+        '''
+        Return the branching factor b for which a btree node on the table's column takes about page_size bytes.
+        A node holds b-1 keys and b ptrs: ints and floats are counted as 8 bytes, other keys by the average
+        length of (a sample of) their string representation.
+
+        table_name -> table's name (needs to exist in database)
+        column_name -> the indexed column
+        page_size -> the byte budget of a node
+        '''
+        table = self.tables[table_name]
+        column_idx = table.column_names.index(column_name)
+        if table.column_types[column_idx] in (int, float):
+            key_size = 8
+        else:
+            sample = [key for key in islice(table.columns[column_idx], sample_size) if key is not None]
+            key_size = sum(len(str(key).encode()) for key in sample) / len(sample) if sample else 8
+        # every key comes with an 8 byte ptr
+        return max(3, int(page_size // (key_size + 8)))
+
     def _has_index(self, table_name):
         '''
-        Check whether the specified table's primary key column is indexed
+        Check whether any column of the specified table is indexed
 
         table_name -> table's name (needs to exist in database)
         '''
         return table_name in self.tables['meta_indexes'].table_name
 
+    def _index_name(self, table_name, column_name, index_type):
+        '''
+        Return the name of the index of index_type on the specified column of a table (None if there is none)
+
+        table_name -> table's name (needs to exist in database)
+        column_name -> the indexed column
+        index_type -> 'Btree' or 'Hash'
+        '''
+        meta = self.tables['meta_indexes']
+        for row in zip(meta.table_name, meta.index_name, meta.column_name, meta.index_type):
+            if row[0] == table_name and row[2] == column_name and row[3] == index_type:
+                return row[1]
+        return None
+
+    def _table_indexes(self, table_name):
+        '''
+        Return (index_name, column_name, index_type, b, include) for every index of a table
+
+        table_name -> table's name (needs to exist in database)
+        '''
+        meta = self.tables['meta_indexes']
+        return [row[1:] for row in zip(meta.table_name, meta.index_name, meta.column_name, meta.index_type, meta.b, meta.include)
+                if row[0] == table_name]
+
+    def _index_values(self, table_name, rows, column_names=None):
+        '''
+        Return the values of the indexed (and included) columns of a table in positions rows ({column_name: [values]}).
+        Taken before the rows are changed, they are what _update_indexes needs to remove the old index entries.
+
+        table_name -> table's name (needs to exist in database)
+        rows -> the positions of the rows
+        column_names -> only consider the indexes on (or including) these columns (ie the column an update sets).
+                        Def: None (all indexes)
+        '''
+        table = self.tables[table_name]
+        values = {}
+        for _, column_name, _, _, include in self._table_indexes(table_name):
+            index_columns = [column_name] + include
+            if column_names is None or any(name in column_names for name in index_columns):
+                for name in index_columns:
+                    column = table.columns[table.column_names.index(name)]
+                    values[name] = [column[row] for row in rows]
+        return values
+
+    def _update_indexes(self, table_name, rows, old_values=None):
+        '''
+        Bring the indexes of a table up to date after the rows in positions rows were changed.
+        The entries of the old values are deleted from the indexes and the new values are inserted.
+
+        table_name -> table's name (needs to exist in database)
+        rows -> the positions of the changed rows
+        old_values -> the values of the indexed columns in rows before the change (see _index_values).
+                      Def: None (the rows were empty, ie slots of the insert_stack or appended rows)
+        '''
+        table = self.tables[table_name]
+        for index_name, column_name, index_type, _, include in self._table_indexes(table_name):
+            if old_values is not None and column_name not in old_values:
+                continue
+            # an entry is the indexed value followed by the values of the included columns
+            index_columns = [column_name] + include
+            columns = [table.columns[table.column_names.index(name)] for name in index_columns]
+            if old_values is not None:
+                old = list(zip(*[old_values[name] for name in index_columns]))
+            else:
+                old = [(None,)*len(index_columns)]*len(rows)
+            changes = [(row, old_entry, new_entry) for row, old_entry, new_entry
+                       in zip(rows, old, zip(*[[column[row] for row in rows] for column in columns])) if old_entry != new_entry]
+            if not changes:
+                continue
+            index = self._load_idx(index_name, index_type)
+            try:
+                # all the old entries are removed before the new ones are added (a value may move between rows)
+                for row, old_entry, _ in changes:
+                    if old_entry[0] is not None:
+                        index.delete(old_entry[0], row)
+                for row, _, new_entry in changes:
+                    if new_entry[0] is not None:
+                        if include:
+                            index.insert(new_entry[0], row, included=new_entry[1:])
+                        else:
+                            index.insert(new_entry[0], row)
+                self._save_index(index_name, index)
+            except BaseException:
+                # the cached btree may have been changed half way
+                self._index_cache.pop(index_name, None)
+                raise
+            finally:
+                if isinstance(index, HashIndex):
+                    index.close()
+
+    def _covering_index(self, table_name, columns, condition, order_by=None):
+        '''
+        Return (btree, column_name) for a covering btree on a column of the condition that stores every column
+        the select needs (the returned columns, the condition columns and order_by), or None if there is none.
+
+        table_name -> table's name (needs to exist in database)
+        columns -> the returned columns (or '*')
+        condition -> the condition of the select
+        order_by -> the column the result is ordered by
+        '''
+        table = self.tables[table_name]
+        needed = set(table.column_names if columns == '*' else columns)
+        condition_columns = {column_name for column_name, _, _ in table._parse_conditions(condition)}
+        needed |= condition_columns
+        if order_by is not None:
+            needed.add(order_by)
+        for index_name, column_name, index_type, _, include in self._table_indexes(table_name):
+            if index_type == 'Btree' and include and column_name in condition_columns and needed <= {column_name, *include}:
+                return self._load_idx(index_name), column_name
+        return None
+
+    def _get_index(self, table_name, column_name, operator='=='):
+        '''
+        Load and return the index that should be used to evaluate a condition with operator on the specified
+        column of a table (None if there is none): a hash index for ==, else (and for the other operators) a btree.
+
+        table_name -> table's name (needs to exist in database)
+        column_name -> the indexed column
+        operator -> the operator of the condition
+        '''
+        for index_type in (['Hash', 'Btree'] if operator == '==' else ['Btree']):
+            index_name = self._index_name(table_name, column_name, index_type)
+            if index_name is not None:
+                return self._load_idx(index_name, index_type)
+        return None
+
     def _save_index(self, index_name, index):
         '''
         Save the index object
 
         index_name -> name of the created index
-        index -> the actual index object (btree object)
+        index -> the actual index object (btree or hash index object)
         '''
         try:
             os.mkdir(f'{self.savedir}/indexes')
         except:
             pass
 
-        with open(f'{self.savedir}/indexes/meta_{index_name}_index.pkl', 'wb') as f:
-            pickle.dump(index, f)
+        if isinstance(index, HashIndex):
+            # hash indexes have their own format, so that a lookup only reads one bucket. Only the changed buckets
+            # of an index that was loaded are written, unless the whole index needs to be written again
+            filename = f'{self.savedir}/indexes/meta_{index_name}_index.hash'
+            if not index.save_changes(filename):
+                self._dump(index, filename, write=HashIndex.write)
+        else:
+            filename = f'{self.savedir}/indexes/meta_{index_name}_index.pkl'
+            self._dump(index, filename)
+            self._index_cache[index_name] = (self._signature(filename), index)
 
-    def _load_idx(self, index_name):
+    def _load_idx(self, index_name, index_type='Btree'):
         '''
         load and return the specified index
+        A btree is kept in memory and only loaded again if its file has changed since it was last loaded or saved
+        (like the tables, see _load_table). A hash index is opened every time, that only reads its header.
 
         index_name -> name of the created index
+        index_type -> 'Btree' or 'Hash'. Def: 'Btree'
         '''
-        f = open(f'{self.savedir}/indexes/meta_{index_name}_index.pkl', 'rb')
+        if index_type == 'Hash':
+            return HashIndex.open(f'{self.savedir}/indexes/meta_{index_name}_index.hash')
+        filename = f'{self.savedir}/indexes/meta_{index_name}_index.pkl'
+        signature = self._signature(filename)
+        cached = self._index_cache.get(index_name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        f = open(filename, 'rb')
         index = pickle.load(f)
         f.close()
+        self._index_cache[index_name] = (signature, index)
         return index
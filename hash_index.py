@@ -0,0 +1,214 @@
+'''
+Persistent hash index (equality lookups only).
+
+The values are hashed (crc32 of their str, so the hash is the same in every process) to a fixed number
+of buckets. Every bucket is a dict (value -> ptr, or value -> list of ptrs if the index is not unique).
+
+On disk format:
+    MAGIC | unique (1 byte) | number of buckets n (4 bytes) | number of values (8 bytes) | directory | buckets
+where the directory holds the offset (from the start of the file) and the length of every bucket (8 bytes each)
+and every bucket is pickled separately.
+An index opened from a file only reads the header and the directory. A lookup reads (and keeps) the single bucket it needs.
+The file is kept open, so the buckets are read from the version of the file that was opened, even if the index
+is saved again in the meantime, until the index is closed.
+
+Saving an index that was opened from a file only writes the buckets that have changed (save_changes): they are
+appended to the file and then their directory entries are pointed to them. The old versions of the buckets are
+never overwritten, so an index that is open keeps reading the buckets it expects. The whole file is written
+again (write) when the number of buckets is doubled or when the old versions take more space than the buckets.
+'''
+from array import array
+import os
+import pickle
+import struct
+import zlib
+
+MAGIC = b'MDBHASH2'
+HEADER = struct.Struct('<?IQ')
+# average number of values per bucket the index is sized for
+BUCKET_SIZE = 32
+
+
+class HashIndex:
+    def __init__(self, unique=True, no_of_buckets=1):
+        '''
+        unique: if False, a value can be inserted more than once and every value keeps a list of ptrs (a posting list)
+        no_of_buckets: the number of buckets the values are hashed to
+        '''
+        self.unique = unique
+        self.no_of_buckets = no_of_buckets
+        self._buckets = [{} for _ in range(no_of_buckets)]  # None for a bucket that has not been read from file yet
+        self._no_of_values = 0
+        self._file = None
+        self._directory = None  # offset and length of every bucket in _file
+        self._changed = set()  # the buckets that have changed since the index was opened or saved
+
+    @classmethod
+    def open(cls, filename):
+        '''
+        Open the index saved in filename. Only the header and the directory are read, buckets are read when they are needed.
+        '''
+        index = cls.__new__(cls)
+        f = open(filename, 'rb')
+        if f.read(len(MAGIC)) != MAGIC:
+            f.close()
+            raise ValueError(f'"{filename}" is not a hash index file.')
+        index.unique, index.no_of_buckets, index._no_of_values = HEADER.unpack(f.read(HEADER.size))
+        index._directory = array('Q')
+        index._directory.frombytes(f.read(16 * index.no_of_buckets))
+        index._buckets = [None] * index.no_of_buckets
+        index._changed = set()
+        index._file = f
+        return index
+
+    def close(self):
+        '''
+        Close the file of an index opened with open. Buckets that have not been read cannot be read afterwards.
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _hash(self, value):
+        return zlib.crc32(str(value).encode()) % self.no_of_buckets
+
+    def _data_start(self):
+        return len(MAGIC) + HEADER.size + 16 * self.no_of_buckets
+
+    def _bucket(self, idx):
+        '''
+        Return bucket idx, reading it from the file if needed.
+        '''
+        bucket = self._buckets[idx]
+        if bucket is None:
+            offset, length = self._directory[2*idx], self._directory[2*idx + 1]
+            self._file.seek(offset)
+            bucket = pickle.loads(self._file.read(length))
+            self._buckets[idx] = bucket
+        return bucket
+
+    def _too_crowded(self):
+        return self._no_of_values > 2 * BUCKET_SIZE * self.no_of_buckets
+
+    def bulk_load(self, items):
+        '''
+        Build the index from (value, ptr) pairs, replacing its contents.
+        The number of buckets is chosen so that a bucket holds about BUCKET_SIZE values.
+        '''
+        items = list(items)
+        self.close()
+        self.no_of_buckets = max(1, len(items) // BUCKET_SIZE)
+        self._buckets = [{} for _ in range(self.no_of_buckets)]
+        self._no_of_values = 0
+        for value, ptr in items:
+            self.insert(value, ptr)
+
+    def insert(self, value, ptr):
+        '''
+        Insert the value and its ptr to the index.
+        '''
+        idx = self._hash(value)
+        bucket = self._bucket(idx)
+        if value not in bucket:
+            self._no_of_values += 1
+        if self.unique:
+            bucket[value] = ptr
+        else:
+            bucket.setdefault(value, []).append(ptr)
+        self._changed.add(idx)
+
+    def delete(self, value, ptr=None):
+        '''
+        Delete the value from the index. If the index is not unique and ptr is given, only ptr is removed from
+        the posting list of the value.
+        '''
+        idx = self._hash(value)
+        bucket = self._bucket(idx)
+        if value not in bucket:
+            return
+        self._changed.add(idx)
+        if not self.unique and ptr is not None:
+            ptrs = bucket[value]
+            if ptr in ptrs:
+                ptrs.remove(ptr)
+            if ptrs:
+                return
+        del bucket[value]
+        self._no_of_values -= 1
+
+    def find(self, operator, value, return_ops=False):
+        '''
+        Return the ptrs of the elements that are equal to value. Only "==" is supported.
+
+        return_ops: set to True if you want to use the number of operations (returned instead of printed)
+        '''
+        if operator != '==':
+            raise ValueError(f'Hash index only supports "==", not "{operator}".')
+        ptr = self._bucket(self._hash(value)).get(value)
+        if ptr is None:
+            results = []
+        else:
+            results = [ptr] if self.unique else list(ptr)
+        # a hash probe is a single comparison
+        if return_ops:
+            return results, 1
+        print('With Hash index -> 1 comparison operations')
+        return results
+
+    def save_changes(self, filename):
+        '''
+        Write the changed buckets of an index that was opened from filename back to the file. Returns False
+        (without writing anything) if the whole index needs to be written with write instead: it was not opened
+        from filename, it is too crowded (write doubles its number of buckets) or the old versions of the buckets
+        would take more space in the file than the buckets themselves.
+        '''
+        if self._file is None or self._too_crowded():
+            return False
+        fd = os.open(filename, os.O_RDWR)
+        try:
+            stat = os.fstat(fd)
+            opened = os.fstat(self._file.fileno())
+            # the file has been replaced since the index was opened
+            if (stat.st_dev, stat.st_ino) != (opened.st_dev, opened.st_ino):
+                return False
+            changed = sorted(self._changed)
+            blobs = [pickle.dumps(self._buckets[idx]) for idx in changed]
+            new_size = sum(map(len, blobs))
+            live = sum(self._directory[1::2]) - sum(self._directory[2*idx + 1] for idx in changed) + new_size
+            if stat.st_size + new_size - self._data_start() > 2 * live:
+                return False
+            # the buckets are appended first, so a directory entry never points to a bucket that is not (fully) written
+            offset = stat.st_size
+            os.pwrite(fd, b''.join(blobs), offset)
+            for idx, blob in zip(changed, blobs):
+                self._directory[2*idx] = offset
+                self._directory[2*idx + 1] = len(blob)
+                offset += len(blob)
+                os.pwrite(fd, self._directory[2*idx:2*idx + 2].tobytes(), len(MAGIC) + HEADER.size + 16 * idx)
+            os.pwrite(fd, HEADER.pack(self.unique, self.no_of_buckets, self._no_of_values), len(MAGIC))
+        finally:
+            os.close(fd)
+        self._changed = set()
+        return True
+
+    @staticmethod
+    def write(index, f):
+        '''
+        Write the whole index to the (binary) file object f. If it is too crowded, the number of buckets is doubled first.
+        '''
+        buckets = [index._bucket(idx) for idx in range(index.no_of_buckets)]
+        if index._too_crowded():
+            index.bulk_load([(value, ptr) for bucket in buckets for value, ptrs in bucket.items()
+                             for ptr in ([ptrs] if index.unique else ptrs)])
+            buckets = index._buckets
+        blobs = [pickle.dumps(bucket) for bucket in buckets]
+        directory = array('Q')
+        offset = index._data_start()
+        for blob in blobs:
+            directory.extend((offset, len(blob)))
+            offset += len(blob)
+        f.write(MAGIC)
+        f.write(HEADER.pack(index.unique, index.no_of_buckets, index._no_of_values))
+        f.write(directory.tobytes())
+        for blob in blobs:
+            f.write(blob)
@@ -0,0 +1,60 @@
+from table import Table
+from database import Database
+from time import perf_counter
+import contextlib
+import io
+
+'''
+Benchmark Table._insert and Database.insert
+
+Rows are inserted in batches. If the columns are maintained incrementally,
+the average cost of an insert should stay (roughly) the same as the table grows.
+The primary key uniqueness check uses the pk index, so the same holds for tables with a primary key.
+
+Database.insert also locks, loads, logs and updates the meta tables. None of these should depend on the
+size of the table either, so its cost is measured as the table grows as well (the table is grown with insert_many
+and checkpointed before every timed batch).
+'''
+
+BATCH = 5000
+BATCHES = 10
+
+for primary_key in [None, 'ID']:
+    table = Table(name='bench', column_names=['ID', 'name', 'dept_name', 'tot_cred'],
+                  column_types=[str, str, str, int], primary_key=primary_key)
+
+    print(f'Primary key: {primary_key}')
+    print(f'{"rows":>8}  {"us/insert":>10}')
+
+    for batch in range(BATCHES):
+        start = perf_counter()
+        for i in range(batch*BATCH, (batch+1)*BATCH):
+            table._insert([str(i), f'name{i}', f'dept{i%20}', i%150])
+        elapsed = perf_counter() - start
+
+        print(f'{len(table.data):>8}  {elapsed/BATCH*1e6:>10.2f}')
+
+
+DB_BATCH = 200
+DB_GROWTH = 50000
+
+print('Database.insert')
+print(f'{"rows":>8}  {"us/insert":>10}')
+with contextlib.redirect_stdout(io.StringIO()):
+    db = Database('insert_benchmark', load=False)
+    db.create_table('bench', ['ID', 'name', 'dept_name', 'tot_cred'], [str, str, str, int], primary_key='ID')
+no_of_rows = 0
+for batch in range(BATCHES):
+    with contextlib.redirect_stdout(io.StringIO()):
+        db.insert_many('bench', [[str(i), f'name{i}', f'dept{i%20}', i%150] for i in range(no_of_rows, no_of_rows+DB_GROWTH)])
+        no_of_rows += DB_GROWTH
+        # checkpoint, so that the timed inserts do not include saving the rows of insert_many
+        db.save()
+        start = perf_counter()
+        for i in range(no_of_rows, no_of_rows+DB_BATCH):
+            db.insert('bench', [str(i), f'name{i}', f'dept{i%20}', i%150])
+        elapsed = perf_counter() - start
+        no_of_rows += DB_BATCH
+
+    print(f'{len(db.tables["bench"].data):>8}  {elapsed/DB_BATCH*1e6:>10.2f}')
+db.drop_db()
@@ -0,0 +1,317 @@
+'''
+Table lock manager with shared (S) and exclusive (X) locks.
+
+Every table has a lock file (<savedir>/locks/<table_name>.lock) and a lock is an advisory flock on it,
+so the locks are held by the operating system: they are shared by every process (and every Database object)
+that uses the database, they are checked and taken with a single system call and they are released
+automatically if the process that holds them dies.
+
+    S (shared) -> taken by readers. Any number of S locks can be held at the same time.
+    X (exclusive) -> taken by writers. Conflicts with every other lock.
+
+A lock that can not be taken right away is waited for, up to a timeout (LockTimeout is raised after it).
+The waiters of a table are served in FIFO order: every waiter appends a ticket to the wait queue of the table
+(<savedir>/locks/<table_name>.queue) and it only tries the lock when every ticket ahead of it has been served
+(an S waiter only needs the tickets ahead of it to be S ones, since they can share the lock).
+So a writer that waits is not overtaken by readers that arrive after it. The tickets of dead processes are dropped.
+
+A writer that only changes some rows of a table can lock pages of rows instead of the whole table
+(see lock_pages). Page p is byte p of <savedir>/locks/<table_name>.pages and its X lock is a byte range lock on it
+(an open file description lock on Linux, so like flock it belongs to the LockManager. On other systems it is a
+POSIX record lock, which belongs to the process: page locks do not exclude each other inside a process).
+
+If fcntl is not available (ie on Windows), locking is a no-op (only the reentrancy bookkeeping is kept).
+'''
+from contextlib import contextmanager
+from itertools import count
+from time import perf_counter, sleep
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MODES = ('S', 'X')
+# the first and the longest pause (in seconds) between two tries of a waiter
+MIN_BACKOFF = 0.0005
+MAX_BACKOFF = 0.02
+
+_tickets = count()
+
+
+def is_alive(pid):
+    '''
+    Return True if the process pid is running.
+    '''
+    if int(pid) == os.getpid():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class LockTimeout(Exception):
+    '''
+    Raised when a lock could not be taken before the timeout.
+    '''
+    pass
+
+
+class LockManager:
+    def __init__(self, lock_dir):
+        '''
+        lock_dir -> the directory of the lock files (created when the first lock is taken)
+        '''
+        self.lock_dir = lock_dir
+        self._held = {}  # table_name -> [fd, mode, count] for the locks held through this manager
+        self._probes = {}  # table_name -> fd used to check the locks held by others
+        self._queues = {}  # table_name -> fd of the wait queue file
+        self._pages = {}  # table_name -> [fd, set of X locked pages]
+        # table_name -> [number of waits, number of timeouts, total wait time, longest wait time] (in seconds)
+        self.wait_stats = {}
+
+    def _open(self, table_name, extension='lock'):
+        '''
+        Open (and create if needed) the lock (or wait queue) file of a table and return its file descriptor.
+        '''
+        if not os.path.isdir(self.lock_dir):
+            os.makedirs(self.lock_dir, exist_ok=True)
+        return os.open(os.path.join(self.lock_dir, f'{table_name}.{extension}'), os.O_RDWR | os.O_CREAT, 0o666)
+
+    def _queue(self, table_name):
+        fd = self._queues.get(table_name)
+        if fd is None:
+            fd = self._queues[table_name] = self._open(table_name, 'queue')
+        return fd
+
+    @staticmethod
+    def _read_queue(fd):
+        '''
+        Return the tickets (pid, ticket, mode) of a wait queue file. The queue file needs to be locked.
+        '''
+        size = os.fstat(fd).st_size
+        os.lseek(fd, 0, os.SEEK_SET)
+        return [line.split() for line in os.read(fd, size).decode().splitlines()]
+
+    @staticmethod
+    def _write_queue(fd, tickets):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, ''.join(f'{pid} {ticket} {mode}\n' for pid, ticket, mode in tickets).encode())
+
+    @staticmethod
+    def _flock(fd, mode):
+        '''
+        Try to take (without waiting) a lock of mode on fd. Returns False if it conflicts with a lock of another holder.
+        '''
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if mode == 'S' else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            return True
+        except (BlockingIOError, PermissionError):
+            return False
+
+    def lock(self, table_name, mode='X', timeout=0):
+        '''
+        Lock a table, waiting (in FIFO order) for up to timeout seconds if another holder has a conflicting lock.
+        Raises LockTimeout if the lock was not taken in time.
+        Locks are reentrant: locking a table again only increases a counter. An S lock can not be upgraded to X
+        (flock converts a lock by releasing it first, so the table could be lost to another holder).
+
+        table_name -> the table that will be locked
+        mode -> 'S' (shared) or 'X' (exclusive). Def: 'X'
+        timeout -> the number of seconds to wait. 0 only tries once and None waits for ever. Def: 0
+        '''
+        if mode not in MODES:
+            raise ValueError(f'Lock mode should be one of {MODES}, not "{mode}".')
+        held = self._held.get(table_name)
+        if held is not None:
+            if mode == 'X' and held[1] == 'S':
+                raise Exception(f'Table "{table_name}" is S locked, it can not be X locked by the same holder.')
+            held[2] += 1
+            return True
+
+        fd = self._open(table_name)
+        queue = self._queue(table_name)
+        # fast path, nobody is waiting and the lock is free
+        if os.fstat(queue).st_size == 0 and self._flock(fd, mode):
+            self._held[table_name] = [fd, mode, 1]
+            return True
+
+        start = perf_counter()
+        ticket = [str(os.getpid()), str(next(_tickets)), mode]
+        backoff = MIN_BACKOFF
+        try:
+            while True:
+                if self._try_queued(fd, queue, ticket):
+                    break
+                waited = perf_counter() - start
+                if timeout is not None and waited >= timeout:
+                    self._dequeue(queue, ticket)
+                    self._record_wait(table_name, waited, timed_out=True)
+                    raise LockTimeout(f'Could not {mode} lock table "{table_name}" in {timeout} seconds.')
+                sleep(backoff if timeout is None else min(backoff, timeout - waited))
+                backoff = min(2*backoff, MAX_BACKOFF)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._record_wait(table_name, perf_counter() - start)
+        self._held[table_name] = [fd, mode, 1]
+        return True
+
+    def _try_queued(self, fd, queue, ticket):
+        '''
+        Try to take the lock as the waiter with ticket (it is added to the wait queue the first time).
+        The lock is only tried when the tickets ahead allow it. Returns True (and leaves the queue) if it was taken.
+        '''
+        fcntl.flock(queue, fcntl.LOCK_EX)
+        try:
+            tickets = [entry for entry in self._read_queue(queue) if is_alive(entry[0])]
+            if ticket not in tickets:
+                tickets.append(ticket)
+            ahead = tickets[:tickets.index(ticket)]
+            my_turn = not ahead if ticket[2] == 'X' else all(entry[2] == 'S' for entry in ahead)
+            taken = my_turn and self._flock(fd, ticket[2])
+            if taken:
+                tickets.remove(ticket)
+            self._write_queue(queue, tickets)
+            return taken
+        finally:
+            fcntl.flock(queue, fcntl.LOCK_UN)
+
+    def _dequeue(self, queue, ticket):
+        fcntl.flock(queue, fcntl.LOCK_EX)
+        try:
+            self._write_queue(queue, [entry for entry in self._read_queue(queue) if entry != ticket])
+        finally:
+            fcntl.flock(queue, fcntl.LOCK_UN)
+
+    def _record_wait(self, table_name, waited, timed_out=False):
+        stats = self.wait_stats.setdefault(table_name, [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += timed_out
+        stats[2] += waited
+        stats[3] = max(stats[3], waited)
+
+    def unlock(self, table_name):
+        '''
+        Release a lock taken with lock. The table is unlocked when every lock on it has been released.
+        '''
+        held = self._held.get(table_name)
+        if held is None:
+            return
+        held[2] -= 1
+        if held[2] == 0:
+            # closing the file descriptor releases the flock
+            os.close(held[0])
+            del self._held[table_name]
+
+    @staticmethod
+    def _lock_byte(fd, offset):
+        '''
+        Try to take (without waiting) an exclusive lock on byte offset of fd. Returns False if it is locked by another holder.
+        '''
+        if fcntl is None:
+            return True
+        try:
+            if hasattr(fcntl, 'F_OFD_SETLK'):
+                # struct flock: l_type, l_whence, l_start, l_len, l_pid
+                fcntl.fcntl(fd, fcntl.F_OFD_SETLK, struct.pack('hhqqi4x', fcntl.F_WRLCK, os.SEEK_SET, offset, 1, 0))
+            else:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            return True
+        except (BlockingIOError, PermissionError):
+            return False
+
+    def lock_pages(self, table_name, pages, timeout=0):
+        '''
+        X lock pages of a table, waiting for up to timeout seconds for the pages that are locked by another holder.
+        The pages are locked in ascending order (so two writers can not wait for each other). Raises LockTimeout
+        if a page was not locked in time (the pages already locked are kept, unlock_pages releases them).
+
+        table_name -> the table whose pages will be locked
+        pages -> the numbers of the pages
+        timeout -> the number of seconds to wait. 0 only tries once and None waits for ever. Def: 0
+        '''
+        if table_name not in self._pages:
+            self._pages[table_name] = [self._open(table_name, 'pages'), set()]
+        fd, locked = self._pages[table_name]
+        start = perf_counter()
+        backoff = MIN_BACKOFF
+        blocked = False
+        for page in sorted(set(pages) - locked):
+            while not self._lock_byte(fd, page):
+                blocked = True
+                waited = perf_counter() - start
+                if timeout is not None and waited >= timeout:
+                    self._record_wait(table_name, waited, timed_out=True)
+                    raise LockTimeout(f'Could not lock page {page} of table "{table_name}" in {timeout} seconds.')
+                sleep(backoff if timeout is None else min(backoff, timeout - waited))
+                backoff = min(2*backoff, MAX_BACKOFF)
+            locked.add(page)
+        if blocked:
+            self._record_wait(table_name, perf_counter() - start)
+
+    def unlock_pages(self, table_name):
+        '''
+        Release every page lock on a table.
+        '''
+        if table_name in self._pages:
+            # closing the file descriptor releases the byte range locks
+            os.close(self._pages.pop(table_name)[0])
+
+    @contextmanager
+    def latch(self, table_name):
+        '''
+        A short exclusive section per table (ie writing the table file while only some of its pages are locked).
+        Waits for ever, the sections it protects are short.
+        '''
+        fd = self._open(table_name, 'latch')
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def holds(self, table_name, mode='S'):
+        '''
+        Return True if this manager holds a lock on the table that is at least as strong as mode.
+        '''
+        held = self._held.get(table_name)
+        return held is not None and (mode == 'S' or held[1] == 'X')
+
+    def is_locked(self, table_name, mode='X'):
+        '''
+        Return True if another holder has a lock on the table that conflicts with a lock of mode
+        (ie mode='S' checks for X locks, mode='X' checks for any lock). A table locked by this manager is never
+        reported as locked.
+        '''
+        if fcntl is None or table_name in self._held:
+            return False
+        fd = self._probes.get(table_name)
+        if fd is None:
+            fd = self._probes[table_name] = self._open(table_name)
+        if not self._flock(fd, mode):
+            return True
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+
+    def close(self):
+        '''
+        Release every lock of this manager.
+        '''
+        for fd in [held[0] for held in self._held.values()] + list(self._probes.values()) + list(self._queues.values()) + \
+                [pages[0] for pages in self._pages.values()]:
+            os.close(fd)
+        self._held = {}
+        self._probes = {}
+        self._queues = {}
+        self._pages = {}
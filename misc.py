@@ -1,20 +1,56 @@
 import operator
+import re
+from itertools import compress, count, repeat
+
+OPS = {'>': operator.gt,
+       '<': operator.lt,
+       '>=': operator.ge,
+       '<=': operator.le,
+       '==': operator.eq}
+
+# the same scan as compile_condition's fast path, for columns that contain Nones (deleted records).
+# The comparison is written inline, so no function is called per value.
+SKIP_NONE_SCANS = {'>': lambda column, value: [ind for ind, x in enumerate(column) if x is not None and x > value],
+                   '<': lambda column, value: [ind for ind, x in enumerate(column) if x is not None and x < value],
+                   '>=': lambda column, value: [ind for ind, x in enumerate(column) if x is not None and x >= value],
+                   '<=': lambda column, value: [ind for ind, x in enumerate(column) if x is not None and x <= value],
+                   '==': lambda column, value: [ind for ind, x in enumerate(column) if x is not None and x == value]}
 
 def get_op(op, a, b):
     '''
     Get op as a function of a and b by using a symbol
     '''
-    ops = {'>': operator.gt,
-                '<': operator.lt,
-                '>=': operator.ge,
-                '<=': operator.le,
-                '==': operator.eq}
-
     try:
-        return ops[op](a,b)
+        return OPS[op](a,b)
     except TypeError:  # if a or b is None (deleted record), python3 raises typerror
         return False
 
+def compile_condition(op, value):
+    '''
+    Compile a condition (operator and value) once, into a function that scans a whole column
+    and returns the indexes of the values x where x "op" value is True.
+    Values that can not be compared (ie None in deleted records) never satisfy the condition.
+    '''
+    func = OPS[op]
+
+    def scan(column):
+        # the typed containers of columnar tables have their own (vectorized) scan
+        if not isinstance(column, list):
+            return column.where(op, value)
+        try:
+            # map/compress evaluate the operator for every value without a python level loop
+            return list(compress(count(), map(func, column, repeat(value))))
+        except TypeError:
+            pass
+        try:
+            # the column contains Nones (deleted records)
+            return SKIP_NONE_SCANS[op](column, value)
+        except TypeError:
+            # the column contains values of different types
+            return [ind for ind, x in enumerate(column) if get_op(op, x, value)]
+
+    return scan
+
 def split_condition(condition):
     condition = condition.replace(' ','') # remove all whitespaces
     ops = {'>=': operator.ge,
@@ -27,3 +63,28 @@ def split_condition(condition):
         splt=condition.split(op_key)
         if len(splt)>1:
             return splt[0], op_key, splt[1]
+
+def split_conditions(condition):
+    '''
+    Split a compound condition into a list of simple ones (column, operator, value), see split_condition.
+    Simple conditions are joined with "and", and "column between lo and hi" is the same as "column>=lo and column<=hi".
+    '''
+    condition = re.sub(r'(\S+)\s+between\s+(\S+)\s+and\s+(\S+)', r'\1>=\2 and \1<=\3', condition.strip(), flags=re.IGNORECASE)
+    return [split_condition(part) for part in re.split(r'\s+and\s+', condition, flags=re.IGNORECASE)]
+
+def range_bounds(conditions):
+    '''
+    Combine simple conditions on the same column, given as (operator, value) pairs, into a single range.
+    Returns lo, hi, lo_inclusive, hi_inclusive (a bound is None if the range is not bounded on that side).
+    '''
+    lo, hi, lo_inclusive, hi_inclusive = None, None, True, True
+    for op, value in conditions:
+        if op in ('>', '>=', '=='):
+            inclusive = op != '>'
+            if lo is None or value > lo or (value == lo and not inclusive):
+                lo, lo_inclusive = value, inclusive
+        if op in ('<', '<=', '=='):
+            inclusive = op != '<'
+            if hi is None or value < hi or (value == hi and not inclusive):
+                hi, hi_inclusive = value, inclusive
+    return lo, hi, lo_inclusive, hi_inclusive
@@ -0,0 +1,43 @@
+from table import Table
+from misc import get_op
+from time import perf_counter
+import random
+
+'''
+Benchmark the evaluation of a condition over a whole column
+
+For a 1M row table (row and columnar storage) we compare the old way of evaluating a condition
+(a python loop calling get_op for every value) with Table._rows_where (the condition is compiled once
+and the column is scanned in one pass). 1% of the rows are deleted (full of Nones).
+'''
+
+ROWS = 1000000
+
+random.seed(0)
+rows = [[i, random.choice(['Biology', 'Comp. Sci.', 'Finance', 'History', 'Physics']), random.randrange(100)] for i in range(ROWS)]
+
+conditions = [('tot_cred', '>', 50), ('dept_name', '==', 'Finance')]
+
+print(f'{"storage":>10}  {"condition":>20}  {"get_op (ns/row)":>16}  {"compiled (ns/row)":>18}')
+
+for storage in ['row', 'columnar']:
+    table = Table(name='student', column_names=['ID', 'dept_name', 'tot_cred'], column_types=[int, str, int],
+                  primary_key='ID', storage=storage)
+    table._insert_many([list(row) for row in rows])
+    for i in range(0, ROWS, 100):
+        table._set_row(i, [None, None, None])
+
+    for column_name, operator, value in conditions:
+        column = table.columns[table.column_names.index(column_name)]
+
+        start = perf_counter()
+        rows1 = [ind for ind, x in enumerate(column) if get_op(operator, x, value)]
+        loop = perf_counter() - start
+
+        start = perf_counter()
+        rows2 = table._rows_where(column_name, operator, value)
+        compiled = perf_counter() - start
+
+        assert rows1 == rows2
+        condition = f'{column_name}{operator}{value}'
+        print(f'{storage:>10}  {condition:>20}  {loop/ROWS*1e9:>16.1f}  {compiled/ROWS*1e9:>18.1f}')
@@ -0,0 +1,39 @@
+from table import Table
+from time import perf_counter
+import tracemalloc
+import pickle
+import random
+
+'''
+Compare the row and the columnar storage of Table
+
+For each storage, a "takes"-like table is filled and we measure the memory it uses
+(allocated while building it), the size of its pickle and the time of a full column scan.
+'''
+
+ROWS = 200000
+
+random.seed(0)
+rows = [[str(random.randrange(2000)), str(random.randrange(100, 999)), str(random.randrange(1, 4)),
+         random.choice(['Fall', 'Spring', 'Summer']), random.randrange(2001, 2010),
+         random.choice(['A', 'A-', 'B+', 'B', 'B-', 'C'])] for _ in range(ROWS)]
+
+print(f'{"storage":>10}  {"memory (MB)":>12}  {"pickle (MB)":>12}  {"scan (ms)":>10}')
+
+for storage in ['row', 'columnar']:
+    tracemalloc.start()
+    table = Table(name='takes', column_names=['ID', 'course_id', 'sec_id', 'semester', 'year', 'grade'],
+                  column_types=[str, str, str, str, int, str], storage=storage)
+    table._insert_many([list(row) for row in rows])
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    size = len(pickle.dumps(table))
+
+    start = perf_counter()
+    table._rows_where('year', '>=', 2005)
+    table._rows_where('grade', '==', 'A')
+    elapsed = perf_counter() - start
+
+    print(f'{storage:>10}  {memory/1e6:>12.2f}  {size/1e6:>12.2f}  {elapsed*1e3:>10.2f}')
+    del table
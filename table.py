@@ -2,7 +2,8 @@ from __future__ import annotations
 from tabulate import tabulate
 import pickle
 import os
-from misc import get_op, split_condition
+from misc import OPS, get_op, split_condition, split_conditions, range_bounds, compile_condition
+from columnar import make_column, RowView
 
 class Table:
     '''
@@ -13,6 +14,7 @@ class Table:
         - column names (list of strings)
         - column types (list of functions like str/int etc)
         - primary (name of the primary key column)
+        - storage (optional, 'row' or 'columnar'. See below)
 
     OR
 
@@ -20,8 +22,13 @@ class Table:
             - a path to a Table file saved using the save function
             - a dictionary that includes the appropriate info (all the attributes in __init__)
 
+    Storage:
+        - 'row' (default): data is a list of rows (lists) and every column is also kept as a list.
+        - 'columnar': only the columns are stored, using the typed containers of columnar.py
+          (array buffers for int/float/bool, dictionary encoding for str). data is a RowView over the columns.
+
     '''
-    def __init__(self, name=None, column_names=None, column_types=None, primary_key=None, load=None):
+    def __init__(self, name=None, column_names=None, column_types=None, primary_key=None, load=None, storage='row'):
 
         if load is not None:
             # if load is a dict, replace the object dict with it (replaces the object with the specified one)
@@ -40,6 +47,10 @@ class Table:
             if len(column_names)!=len(column_types):
                 raise ValueError('Need same number of column names and types.')
 
+            if storage not in ['row', 'columnar']:
+                raise ValueError(f'Storage should be "row" or "columnar", not "{storage}".')
+            self._storage = storage
+
             self.column_names = column_names
 
             self.columns = []
@@ -68,14 +79,129 @@ class Table:
 
     # if any of the name, columns_names and column types are none. return an empty table object
 
+    def __setstate__(self, state):
+        '''
+        Restore a pickled table. Tables pickled by older versions of miniDB lack some attributes, they are added here.
+        '''
+        self.__dict__.update(state)
+        if '_storage' not in state:
+            self._storage = 'row'
+        if 'pk_index' not in state:
+            self._update_pk_index()
+
 
     def _update(self):
         '''
         Update all the available column with the appended rows.
         '''
-        self.columns = [[row[i] for row in self.data] for i in range(self._no_of_columns)]
+        if self._storage == 'columnar':
+            rows = list(self.data)
+            self.columns = [make_column(self.column_types[i], [row[i] for row in rows]) for i in range(self._no_of_columns)]
+            self.data = RowView(self.columns)
+        else:
+            self.columns = [[row[i] for row in self.data] for i in range(self._no_of_columns)]
         for ind, col in enumerate(self.column_names):
             setattr(self, col, self.columns[ind])
+        self._update_pk_index()
+        # the table has changed and needs to be saved (the flag is cleared by Database.save)
+        self._dirty = True
+
+    def _update_pk_index(self):
+        '''
+        Rebuild the primary key index (a dict that maps each primary key value to the index of its row).
+        Deleted rows (full of Nones) are skipped.
+        '''
+        if self.pk_idx is None:
+            self.pk_index = None
+            return
+        self.pk_index = {value: ind for ind, value in enumerate(self.columns[self.pk_idx]) if value is not None}
+
+    # The following helpers keep self.data and self.columns in sync one row/cell at a time.
+    # The column lists are the same objects as the column attributes (table.column_name),
+    # so they have to be mutated in place and never replaced. Only _update rebuilds them from scratch.
+    # Every helper marks the table as dirty, so that Database.save knows it has to be written.
+    # For columnar tables self.data is a RowView that writes to the columns, so only one of the two is written.
+
+    def _append_row(self, row):
+        '''
+        Append a row to the end of the table.
+        '''
+        self.data.append(row)
+        if self._storage == 'row':
+            for i, value in enumerate(row):
+                self.columns[i].append(value)
+        self._dirty = True
+        if self.pk_idx is not None and row[self.pk_idx] is not None:
+            self.pk_index[row[self.pk_idx]] = len(self.data)-1
+
+    def _extend_rows(self, rows):
+        '''
+        Append a list of rows to the end of the table (one extend per column).
+        '''
+        start = len(self.data)
+        self.data.extend(rows)
+        if self._storage == 'row':
+            for i, column in enumerate(self.columns):
+                column.extend([row[i] for row in rows])
+        if self.pk_idx is not None:
+            self.pk_index.update((row[self.pk_idx], start+ind) for ind, row in enumerate(rows) if row[self.pk_idx] is not None)
+        self._dirty = True
+
+    def _set_row(self, row_idx, row):
+        '''
+        Replace the row found in position row_idx.
+        '''
+        if self.pk_idx is not None:
+            self._reindex_pk(row_idx, row[self.pk_idx])
+        self.data[row_idx] = row
+        if self._storage == 'row':
+            for i, value in enumerate(row):
+                self.columns[i][row_idx] = value
+        self._dirty = True
+
+    def _set_cell(self, row_idx, column_idx, value):
+        '''
+        Replace a single value of the table.
+        '''
+        if column_idx == self.pk_idx:
+            self._reindex_pk(row_idx, value)
+        if self._storage == 'row':
+            self.data[row_idx][column_idx] = value
+        self.columns[column_idx][row_idx] = value
+        self._dirty = True
+
+    def _pop_row(self, row_idx):
+        '''
+        Remove the row found in position row_idx (shifts every following row by one).
+        '''
+        self.data.pop(row_idx)
+        if self._storage == 'row':
+            for column in self.columns:
+                column.pop(row_idx)
+        self._dirty = True
+        # every following row changed position, so the pk index needs to be rebuilt
+        self._update_pk_index()
+
+    def _reindex_pk(self, row_idx, new_value):
+        '''
+        Point the primary key index to the new primary key value of the row found in position row_idx.
+        '''
+        old_value = self.columns[self.pk_idx][row_idx]
+        if old_value is not None and self.pk_index.get(old_value) == row_idx:
+            del self.pk_index[old_value]
+        if new_value is not None:
+            self.pk_index[new_value] = row_idx
+
+    def _rows_where(self, column_name, operator, value):
+        '''
+        Return the indexes of the rows where the value of column_name "operator" value is True.
+        Equality checks on the primary key are answered by the pk index, everything else by a single
+        scan of the column (see compile_condition). Select, update and delete all use this.
+        '''
+        column_idx = self.column_names.index(column_name)
+        if column_idx == self.pk_idx and operator == '==':
+            return [self.pk_index[value]] if value in self.pk_index else []
+        return compile_condition(operator, value)(self.columns[column_idx])
 
     def _cast_column(self, column_name, cast_type):
         '''
@@ -83,12 +209,21 @@ class Table:
         '''
         # get the column from its name
         column_idx = self.column_names.index(column_name)
-        # for every column's value in each row, replace it with itself but casted as the specified type
-        for i in range(len(self.data)):
-            self.data[i][column_idx] = cast_type(self.data[i][column_idx])
+        if self._storage == 'columnar':
+            # the column needs a container of the new type
+            self.columns[column_idx] = make_column(cast_type, [None if value is None else cast_type(value) for value in self.columns[column_idx]])
+            setattr(self, column_name, self.columns[column_idx])
+            if column_idx == self.pk_idx:
+                self._update_pk_index()
+        else:
+            # for every column's value in each row, replace it with itself but casted as the specified type
+            # (deleted rows stay full of Nones)
+            for i in range(len(self.data)):
+                if self.data[i][column_idx] is not None:
+                    self._set_cell(i, column_idx, cast_type(self.data[i][column_idx]))
         # change the type of the column
         self.column_types[column_idx] = cast_type
-        self._update()
+        self._dirty = True
 
 
     def _insert(self, row, insert_stack=[]):
@@ -107,35 +242,87 @@ class Table:
                 raise ValueError(f'ERROR -> Value {row[i]} is not of type {self.column_types[i]}.')
 
             # if value is to be appended to the primary_key column, check that it doesnt alrady exist (no duplicate primary keys)
-            if i==self.pk_idx and row[i] in self.columns[self.pk_idx]:
+            if i==self.pk_idx and row[i] in self.pk_index:
                 raise ValueError(f'## ERROR -> Value {row[i]} already exists in primary key column.')
 
         # if insert_stack is not empty, append to its last index
         if insert_stack != []:
-            self.data[insert_stack[-1]] = row
+            self._set_row(insert_stack[-1], row)
         else: # else append to the end
-            self.data.append(row)
-        self._update()
+            self._append_row(row)
+
+    def _insert_many(self, rows, insert_stack=[]):
+        '''
+        Insert a list of rows to table.
+        All the rows are validated before anything is inserted, so either all of them are inserted or none.
+        The slots of the insert_stack are filled first (last one first) and the remaining rows are appended.
+        Returns what is left of the insert_stack.
+        '''
+        for row in rows:
+            if len(row)!=self._no_of_columns:
+                raise ValueError(f'ERROR -> Cannot insert {len(row)} values. Only {self._no_of_columns} columns exist')
+
+        # cast the values one column at a time
+        new_columns = []
+        for i, column_type in enumerate(self.column_types):
+            try:
+                new_columns.append([column_type(row[i]) for row in rows])
+            except:
+                # find the value that could not be casted
+                for row in rows:
+                    try:
+                        column_type(row[i])
+                    except:
+                        raise ValueError(f'ERROR -> Value {row[i]} is not of type {column_type}.')
+
+        # check that the new primary keys are unique (between them and with the existing ones)
+        if self.pk_idx is not None:
+            new_keys = set()
+            for key in new_columns[self.pk_idx]:
+                if key in self.pk_index or key in new_keys:
+                    raise ValueError(f'## ERROR -> Value {key} already exists in primary key column.')
+                new_keys.add(key)
+
+        new_rows = [list(row) for row in zip(*new_columns)]
+
+        no_of_slots = min(len(insert_stack), len(new_rows))
+        for slot, row in zip(reversed(insert_stack), new_rows[:no_of_slots]):
+            self._set_row(slot, row)
+        self._extend_rows(new_rows[no_of_slots:])
+
+        return insert_stack[:len(insert_stack)-no_of_slots]
 
     def _update_row(self, set_value, set_column, condition):
         '''
         update where Condition
         '''
-        # parse the condition
-        column_name, operator, value = self._parse_condition(condition)
+        # get the rows where condition is met
+        rows = self._rows_where_condition(condition)
+        self._update_rows(set_value, set_column, rows)
 
-        # get the condition and the set column
-        column = self.columns[self.column_names.index(column_name)]
+    def _update_rows(self, set_value, set_column, rows):
+        '''
+        Set the value of set_column to set_value for the rows in positions rows.
+        '''
         set_column_idx = self.column_names.index(set_column)
-
         # set_columns_indx = [self.column_names.index(set_column_name) for set_column_name in set_column_names]
 
-        # for each value in column, if condition, replace it with set_value
-        for row_ind, column_value in enumerate(column):
-            if get_op(operator, column_value, value):
-                self.data[row_ind][set_column_idx] = set_value
+        # cast the value like insert does (indexes can not compare values of different types)
+        if set_value is not None:
+            try:
+                set_value = self.column_types[set_column_idx](set_value)
+            except:
+                raise ValueError(f'ERROR -> Value {set_value} is not of type {self.column_types[set_column_idx]}.')
+
+        # primary key values need to stay unique
+        if set_column_idx == self.pk_idx and rows:
+            if len(rows) > 1 or (set_value in self.pk_index and self.pk_index[set_value] != rows[0]):
+                raise ValueError(f'## ERROR -> Value {set_value} already exists in primary key column.')
+
+        # for each row where condition is met, replace the value of the set column with set_value
+        for row_ind in rows:
+            self._set_cell(row_ind, set_column_idx, set_value)
 
-        self._update()
                 # print(f"Updated {len(indexes_to_del)} rows")
 
 
@@ -145,15 +332,13 @@ class Table:
         Important: delete replaces the rows to be deleted with rows filled with Nones,
         These rows are then appened to the insert_stack
         '''
-        column_name, operator, value = self._parse_condition(condition)
-
-        indexes_to_del = []
-
-        column = self.columns[self.column_names.index(column_name)]
-        for index, row_value in enumerate(column):
-            if get_op(operator, row_value, value):
-                indexes_to_del.append(index)
+        indexes_to_del = self._rows_where_condition(condition)
+        return self._delete_rows(indexes_to_del)
 
+    def _delete_rows(self, indexes_to_del):
+        '''
+        Deletes the rows in positions indexes_to_del (see _delete_where).
+        '''
         # we pop from highest to lowest index in order to avoid removing the wrong item
         # since we dont delete, we dont have to to pop in that order, but since delete is used
         # to delete from meta tables too, we still implement it.
@@ -161,11 +346,10 @@ class Table:
         for index in sorted(indexes_to_del, reverse=True):
             if self._name[:4] != 'meta':
                 # if the table is not a metatable, replace the row with a row of nones
-                self.data[index] = [None for _ in range(len(self.column_names))]
+                self._set_row(index, [None for _ in range(len(self.column_names))])
             else:
-                self.data.pop(index)
+                self._pop_row(index)
 
-        self._update()
         print(f"Deleted {len(indexes_to_del)} rows")
         # we have to return the deleted indexes, since they will be appended to the insert_stack
         return indexes_to_del
@@ -187,80 +371,158 @@ class Table:
         # if condition is None, return all rows
         # if not, return the rows with values where condition is met for value
         if condition is not None:
-            column_name, operator, value = self._parse_condition(condition)
-            column = self.columns[self.column_names.index(column_name)]
-            rows = [ind for ind, x in enumerate(column) if get_op(operator, x, value)]
+            rows = self._rows_where_condition(condition)
         else:
             rows = [i for i in range(len(self.columns[0]))]
 
         # top k rows
         rows = rows[:top_k]
-        # copy the old dict, but only the rows and columns of data with index in rows/columns (the indexes that we want returned)
-        dict = {(key):([[self.data[i][j] for j in return_cols] for i in rows] if key=="data" else value) for key,value in self.__dict__.items()}
+        return self._select_rows(return_cols, rows, order_by, asc)
 
-        # we need to set the new column names/types and no of columns, since we might
-        # only return some columns
-        dict['column_names'] = [self.column_names[i] for i in return_cols]
-        dict['column_types']   = [self.column_types[i] for i in return_cols]
-        dict['_no_of_columns'] = len(return_cols)
+    def _select_rows(self, return_cols, rows, order_by=None, asc=False):
+        '''
+        Return a new table with the columns return_cols (indexes) of the rows in positions rows.
+        Only the selected values are copied, column by column.
+        '''
+        columns = [[self.columns[j][i] for i in rows] for j in return_cols]
+        return self._table_from_rows(return_cols, [list(row) for row in zip(*columns)], order_by, asc)
+
+    def _table_from_rows(self, return_cols, rows, order_by=None, asc=False):
+        '''
+        Return a new table with the schema of the columns return_cols (indexes) and the rows (lists of values) given.
+        '''
+        # the primary key (if returned) might have moved to another position
+        primary_key = self.column_names[self.pk_idx] if self.pk_idx in return_cols else None
+        table = Table(name=self._name, column_names=[self.column_names[i] for i in return_cols],
+                      column_types=[self.column_types[i] for i in return_cols], primary_key=primary_key, storage=self._storage)
+        table._extend_rows(rows)
 
         # order by the return table if specified
         if order_by is None:
-            return Table(load=dict)
+            return table
         else:
-            return Table(load=dict).order_by(order_by, asc)
-
+            return table.order_by(order_by, asc)
 
-    def _select_where_with_btree(self, return_columns, bt, condition, order_by=None, asc=False, top_k=None):
 
-        # if * return all columns, else find the column indexes for the columns specified
+    def _iter_where(self, return_columns, condition=None, order_by=None, asc=False):
+        '''
+        Same as _select_where, but instead of a new table it returns a generator of the selected rows
+        (lists with the values of return_columns). Deleted rows are skipped and no copy of the data is made.
+        '''
         if return_columns == '*':
             return_cols = [i for i in range(len(self.column_names))]
         else:
             return_cols = [self.column_names.index(colname) for colname in return_columns]
 
+        if condition is not None:
+            rows = self._rows_where_condition(condition)
+        else:
+            rows = range(len(self.data))
 
-        column_name, operator, value = self._parse_condition(condition)
+        # skip the deleted rows (full of Nones). A row of falsy values (ie [0, '']) is not a deleted one
+        rows = [i for i in rows if not all(value is None for value in self.data[i])]
 
-        print("1: ", type(value), " 2: ", self.column_types[self.column_names.index(column_name)])
+        if order_by is not None:
+            column = self.columns[self.column_names.index(order_by)]
+            rows.sort(key=lambda k: column[k], reverse=not asc)
 
-        # if the column in condition is not a primary key, abort the select
-        if column_name != self.column_names[self.pk_idx]:
-            print('Column is not PK. Aborting')
+        for i in rows:
+            row = self.data[i]
+            yield [row[j] for j in return_cols]
 
-        # here we run the same select twice, sequentially and using the btree.
-        # we then check the results match and compare performance (number of operation)
-        column = self.columns[self.column_names.index(column_name)]
 
-        # sequential
-        rows1 = []
-        opsseq = 0
-        for ind, x in enumerate(column):
-            opsseq+=1
-            if get_op(operator, x, value):
-                rows1.append(ind)
-
-        print(f'Without Btree -> {opsseq} comparison operations')
-        # btree find
-        rows = bt.find(operator, value)
-        print('### Seq result ###')
-        print(rows1)
-        print('### Index result ###')
-        print(rows)
+    def _select_where_with_btree(self, return_columns, bt, condition, order_by=None, asc=False, top_k=None, diagnostic=False, index_column=None):
+        '''
+        Select using an index (btree or hash) on a column of the condition. Only the index is probed and
+        only the selected rows and columns are copied.
+        The conditions on the indexed column are combined into a single range scan of the btree
+        (or an equality probe of a hash index), the rest of the conditions filter its rows.
+
+        diagnostic -> If True, the same select is also run sequentially, and both results and their number
+                      of comparison operations are printed. Def: False
+        index_column -> The column the index is on. Def: None (the column of the first condition)
+        '''
+        # if * return all columns, else find the column indexes for the columns specified
+        if return_columns == '*':
+            return_cols = [i for i in range(len(self.column_names))]
+        else:
+            return_cols = [self.column_names.index(colname) for colname in return_columns]
+
+        conditions = self._parse_conditions(condition)
+        if index_column is None:
+            index_column = conditions[0][0]
+        index_conditions = [(operator, value) for column_name, operator, value in conditions if column_name == index_column]
+
+        if len(index_conditions) > 1 and hasattr(bt, 'range'):
+            # a bounded range (ie BETWEEN), only the entries inside it are visited
+            rows = [ptr for _, ptr in bt.range(*range_bounds(index_conditions))]
+            ops = len(rows)
+            rest = [cond for cond in conditions if cond[0] != index_column]
+        else:
+            # index find (an equality if there is one, since a hash index can only answer those)
+            probe = min(index_conditions, key=lambda cond: cond[0] != '==')
+            rows, ops = bt.find(*probe, return_ops=True)
+            rest = [cond for cond in conditions if cond != (index_column,)+probe]
+        rows = self._filter_rows(rows, rest)
+
+        if diagnostic:
+            # here we run the same select sequentially, check the results match and compare performance (number of operation)
+            rows1 = []
+            opsseq = 0
+            for ind in range(len(self.data)):
+                for column_name, operator, value in conditions:
+                    opsseq+=1
+                    x = self.columns[self.column_names.index(column_name)][ind]
+                    if x is None or not get_op(operator, x, value):
+                        break
+                else:
+                    rows1.append(ind)
+
+            print(f'Without index -> {opsseq} comparison operations')
+            print(f'With index -> {ops} comparison operations')
+            print('### Seq result ###')
+            print(rows1)
+            print('### Index result ###')
+            print(sorted(rows))
 
+        # the index returns the rows in the order of its values, return them in table order (like a scan does)
+        rows = sorted(rows)
         # same as simple select from now on
         rows = rows[:top_k]
-        # TODO: this needs to be dumbed down
-        dict = {(key):([[self.data[i][j] for j in return_cols] for i in rows] if key=="data" else value) for key,value in self.__dict__.items()}
+        return self._select_rows(return_cols, rows, order_by, asc)
 
-        dict['column_names'] = [self.column_names[i] for i in return_cols]
-        dict['column_types']   = [self.column_types[i] for i in return_cols]
-        dict['_no_of_columns'] = len(return_cols)
 
-        if order_by is None:
-            return Table(load=dict)
+    def _select_where_from_index(self, return_columns, bt, condition, index_column, order_by=None, asc=False, top_k=None):
+        '''
+        Select using only a covering btree (one that stores the values of every column the select needs in its leaves).
+        The rows of the table are never read: the conditions on index_column are a range scan of the btree and the
+        rest of the conditions are checked on the included values of its entries.
+
+        index_column -> The column the btree is on
+        '''
+        if return_columns == '*':
+            return_cols = [i for i in range(len(self.column_names))]
         else:
-            return Table(load=dict).order_by(order_by, asc)
+            return_cols = [self.column_names.index(colname) for colname in return_columns]
+
+        # position of every column in an entry (the indexed value followed by the included values)
+        entry_columns = [index_column] + list(bt.include)
+        conditions = [(entry_columns.index(column_name), operator, value) for column_name, operator, value
+                      in self._parse_conditions(condition)]
+        index_conditions = [(operator, value) for pos, operator, value in conditions if pos == 0]
+        rest = [(pos, OPS[operator], value) for pos, operator, value in conditions if pos != 0]
+
+        entries = []
+        for value, ptr, included in bt.range(*range_bounds(index_conditions), with_included=True):
+            entry = (value,) + included
+            if all(entry[pos] is not None and func(entry[pos], right) for pos, func, right in rest):
+                entries.append((ptr, entry))
+
+        # return the rows in table order (like a scan does)
+        entries.sort(key=lambda entry: entry[0])
+        entries = entries[:top_k]
+        positions = [entry_columns.index(self.column_names[i]) for i in return_cols]
+        return self._table_from_rows(return_cols, [[entry[pos] for pos in positions] for _, entry in entries], order_by, asc)
 
 
     def order_by(self, column_name, asc=False):
@@ -268,27 +530,39 @@ class Table:
         Order by based on column
         '''
         # get column, sort values and return sorted indexes
-        column = self.columns[self.column_names.index(column_name)]
-        idx = sorted(range(len(column)), key=lambda k: column[k], reverse=not asc)
+        idx = self._sorted_indexes(column_name, asc)
         # return table but arange data using idx list (sorted indexes)
         dict = {(key):([self.data[i] for i in idx] if key=="data" else value) for key, value in self.__dict__.items()}
         return Table(load=dict)
 
 
+    def _sorted_indexes(self, column_name, asc=False):
+        '''
+        Return the row indexes sorted by the values of a column.
+        Rows with no value (deleted ones) can not be compared, so they are placed at the end.
+        '''
+        column = self.columns[self.column_names.index(column_name)]
+        idx = sorted([k for k in range(len(column)) if column[k] is not None], key=lambda k: column[k], reverse=not asc)
+        return idx + [k for k in range(len(column)) if column[k] is None]
+
     def _sort(self, column_name, asc=False):
         '''
         Same as order by, but its persistant
         '''
-        column = self.columns[self.column_names.index(column_name)]
-        idx = sorted(range(len(column)), key=lambda k: column[k], reverse=not asc)
+        idx = self._sorted_indexes(column_name, asc)
         # print(idx)
         self.data = [self.data[i] for i in idx]
         self._update()
 
 
-    def _inner_join(self, table_right: Table, condition):
+    def _inner_join(self, table_right: Table, condition, algorithm=None, index=None):
         '''
         Join table (left) with a supplied table (right) where condition is met.
+
+        algorithm -> 'index' (needs index), 'hash' (only for ==), 'sort_merge' or 'nested_loop'.
+                     Def: None (index if an index is supplied, else hash for ==, sort_merge for the rest,
+                     nested_loop if the values can not be hashed/sorted)
+        index -> A btree index on the join column of the right table. Def: None
         '''
         # get columns and operator
         column_name_left, operator, column_name_right = self._parse_condition(condition, join=True)
@@ -310,24 +584,140 @@ class Table:
         join_table_coltypes = self.column_types+table_right.column_types
         join_table = Table(name=join_table_name, column_names=join_table_colnames, column_types= join_table_coltypes)
 
+        if algorithm is None:
+            if index is not None:
+                algorithm = 'index'
+            else:
+                algorithm = 'hash' if operator == '==' else 'sort_merge'
+        if algorithm == 'hash' and operator != '==':
+            raise ValueError('Hash join can only be used with the == operator.')
+        if algorithm == 'index' and index is None:
+            raise ValueError('Index join needs an index on the join column of the right table.')
+
+        join = {'index': lambda *args: self._index_nested_loop_join(*args, index),
+                'hash': self._hash_join, 'sort_merge': self._sort_merge_join, 'nested_loop': self._nested_loop_join}[algorithm]
+        try:
+            rows, no_of_ops = join(table_right, column_index_left, operator, column_index_right)
+        except TypeError:
+            # the join values can not be hashed/sorted, only the nested loop can be used
+            algorithm = 'nested_loop'
+            rows, no_of_ops = self._nested_loop_join(table_right, column_index_left, operator, column_index_right)
+
+        # the output is appended all at once
+        join_table._extend_rows(rows)
+
+        print(f'## Join algorithm -> {algorithm}')
+        print(f'## Select ops no. -> {no_of_ops}')
+        print(f'# Left table size -> {len(self.data)}')
+        print(f'# Right table size -> {len(table_right.data)}')
+
+        return join_table
+
+
+    # The join algorithms return the joined rows and the number of operations (comparisons, hash inserts/probes)
+    # they needed, so that they can be compared. Rows with no value in the join column (deleted) never match.
+
+    def _nested_loop_join(self, table_right, column_index_left, operator, column_index_right):
+        '''
+        Compare every left row with every right row.
+        '''
+        rows = []
         # count the number of operations (<,> etc)
         no_of_ops = 0
         # this code is dumb on purpose... it needs to illustrate the underline technique
         # for each value in left column and right column, if condition, append the corresponding row to the new table
         for row_left in self.data:
             left_value = row_left[column_index_left]
+            if left_value is None:
+                continue
             for row_right in table_right.data:
                 right_value = row_right[column_index_right]
                 no_of_ops+=1
-                if get_op(operator, left_value, right_value): #EQ_OP
-                    join_table._insert(row_left+row_right)
-
-        print(f'## Select ops no. -> {no_of_ops}')
-        print(f'# Left table size -> {len(self.data)}')
-        print(f'# Right table size -> {len(table_right.data)}')
-
-        return join_table
+                if right_value is not None and get_op(operator, left_value, right_value): #EQ_OP
+                    rows.append(row_left+row_right)
+        return rows, no_of_ops
 
+    def _index_nested_loop_join(self, table_right, column_index_left, operator, column_index_right, index):
+        '''
+        Probe the index of the right table once for every left row, instead of scanning the right table.
+        '''
+        # left "operator" right is the same as right "mirrored operator" left, and the btree needs the latter
+        # (its values are always the left side of the comparison)
+        mirrored = {'==': '==', '<': '>', '<=': '>=', '>': '<', '>=': '<='}[operator]
+        rows = []
+        no_of_ops = 0
+        for row_left in self.data:
+            left_value = row_left[column_index_left]
+            if left_value is None:
+                continue
+            ptrs, ops = index.find(mirrored, left_value, return_ops=True)
+            no_of_ops+=ops
+            for ptr in ptrs:
+                row_right = table_right.data[ptr]
+                # skip the rows that have been deleted (or changed) since the index was built
+                if get_op(operator, left_value, row_right[column_index_right]):
+                    rows.append(row_left+row_right)
+        return rows, no_of_ops
+
+    def _hash_join(self, table_right, column_index_left, operator, column_index_right):
+        '''
+        Build a hash table (value -> rows) on the right table and probe it once for every left row (== only).
+        '''
+        no_of_ops = 0
+        # build
+        buckets = {}
+        for row_right in table_right.data:
+            right_value = row_right[column_index_right]
+            if right_value is None:
+                continue
+            no_of_ops+=1
+            buckets.setdefault(right_value, []).append(row_right)
+        # probe
+        rows = []
+        for row_left in self.data:
+            left_value = row_left[column_index_left]
+            if left_value is None:
+                continue
+            no_of_ops+=1
+            for row_right in buckets.get(left_value, []):
+                rows.append(row_left+row_right)
+        return rows, no_of_ops
+
+    def _sort_merge_join(self, table_right, column_index_left, operator, column_index_right):
+        '''
+        Sort both tables on the join column and merge them. Since both sides are sorted, the position of the first
+        right value that satisfies (or stops satisfying) the condition only moves forward as we go through the left values.
+        '''
+        no_of_ops = 0
+        left = sorted([row for row in self.data if row[column_index_left] is not None], key=lambda row: row[column_index_left])
+        right = sorted([row for row in table_right.data if row[column_index_right] is not None], key=lambda row: row[column_index_right])
+        right_values = [row[column_index_right] for row in right]
+
+        # for each left value, the matching right rows are right[lo:hi]
+        # lo/hi are the first positions where right value >= left value (_left) or > left value (_right) (as in bisect)
+        rows = []
+        pos_left, pos_right = 0, 0
+        for row_left in left:
+            left_value = row_left[column_index_left]
+            while pos_left < len(right_values):
+                no_of_ops+=1
+                if not right_values[pos_left] < left_value:
+                    break
+                pos_left+=1
+            pos_right = max(pos_right, pos_left)
+            while pos_right < len(right_values):
+                no_of_ops+=1
+                if not right_values[pos_right] <= left_value:
+                    break
+                pos_right+=1
+            lo, hi = {'==': (pos_left, pos_right),
+                      '<': (pos_right, len(right)),
+                      '<=': (pos_left, len(right)),
+                      '>': (0, pos_left),
+                      '>=': (0, pos_right)}[operator]
+            for row_right in right[lo:hi]:
+                rows.append(row_left+row_right)
+        return rows, no_of_ops
 
     def show(self, no_of_rows=None, is_locked=False):
         '''
@@ -351,6 +741,37 @@ class Table:
         print(tabulate(non_none_rows[:no_of_rows], headers=headers)+'\n')
 
 
+    def _rows_where_condition(self, condition):
+        '''
+        Return the indexes of the rows where a (possibly compound, see split_conditions) condition is met.
+        The rows of one condition are found with _rows_where (an equality on the primary key is preferred,
+        since it is answered by the pk index) and the other conditions only check these rows.
+        '''
+        conditions = self._parse_conditions(condition)
+        conditions.sort(key=lambda cond: not (cond[1] == '==' and self.column_names.index(cond[0]) == self.pk_idx))
+        return self._filter_rows(self._rows_where(*conditions[0]), conditions[1:])
+
+    def _filter_rows(self, rows, conditions):
+        '''
+        Return the rows (indexes) that meet all the conditions (column, operator, value).
+        '''
+        for column_name, operator, value in conditions:
+            column = self.columns[self.column_names.index(column_name)]
+            func = OPS[operator]
+            rows = [ind for ind in rows if column[ind] is not None and func(column[ind], value)]
+        return rows
+
+    def _parse_conditions(self, condition):
+        '''
+        Parse a (possibly compound, see split_conditions) condition and return a list of (column, operator, casted value)
+        '''
+        conditions = []
+        for left, op, right in split_conditions(condition):
+            if left not in self.column_names:
+                raise ValueError(f'Condition is not valid (cant find column name)')
+            conditions.append((left, op, self.column_types[self.column_names.index(left)](right)))
+        return conditions
+
     def _parse_condition(self, condition, join=False):
         '''
         Parse the single string condition and return column/s value and operator
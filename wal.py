@@ -0,0 +1,179 @@
+'''
+Write-ahead log of a database.
+
+Every statement that changes a table appends a single record to the log (savedir/wal.log) instead of rewriting
+the table files. The tables are only written at a checkpoint, which then empties the log.
+
+On disk format:
+    MAGIC | generation (8 bytes) | record | record | ...
+where a record is its length (4 bytes), the crc32 of its data (4 bytes) and its data (a pickled object).
+A checkpoint truncates the log and increases the generation, so a reader can tell that the records it
+has read are gone (and are now part of the table files). The new generation is written over the old one before
+the records are cut off, so a crash in between leaves a valid log (whose records are applied again, which is
+harmless since they hold the new values of the rows).
+A record that is cut short or whose crc32 does not match (ie the write was interrupted by a crash) ends the log.
+
+Group commit: append only returns once its record has been fsynced. The records of the threads that append
+while an fsync is running are made durable together by the next one: the first of them to wait becomes the leader
+and fsyncs every record written so far, the others wait for it.
+'''
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b'MDBWAL01'
+HEADER = struct.Struct('<Q')
+RECORD = struct.Struct('<II')
+# the size of MAGIC and the header, the records start there
+RECORDS_START = len(MAGIC) + HEADER.size
+
+
+class WriteAheadLog:
+    def __init__(self, filename, sync_interval=0):
+        '''
+        filename -> the log file (created when the first record is appended)
+        sync_interval -> the time (in seconds) the leader of a group commit waits for more records before it fsyncs.
+                         It delays every append by as much. Def: 0 (fsync right away)
+        '''
+        self.filename = filename
+        self.sync_interval = sync_interval
+        self._fd = None
+        # the number of records written and fsynced, and whether a leader is fsyncing
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._sync_cond = threading.Condition()
+
+    def _open(self):
+        if self._fd is None:
+            if not os.path.exists(self.filename):
+                # the file is created with its header in place (linking fails if another process created it first).
+                # Unlike a mkstemp file (owner only), it gets the default mode of a new file (0o666 & ~umask)
+                tmp_filename = f'{self.filename}.{os.urandom(8).hex()}.tmp'
+                fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                os.write(fd, MAGIC + HEADER.pack(0))
+                os.close(fd)
+                try:
+                    os.link(tmp_filename, self.filename)
+                except FileExistsError:
+                    pass
+                os.remove(tmp_filename)
+            self._fd = os.open(self.filename, os.O_RDWR | os.O_APPEND)
+            if os.fstat(self._fd).st_size < RECORDS_START:
+                # the header was lost (ie the file was emptied by a crash), the log starts over from generation 0
+                self._write_header(0)
+        return self._fd
+
+    def _write_header(self, generation):
+        '''
+        Write MAGIC and the header with generation at the start of the file (in place, pwrite ignores the
+        offset of a file opened with O_APPEND) and fsync it.
+        '''
+        fd = os.open(self.filename, os.O_WRONLY)
+        try:
+            os.pwrite(fd, MAGIC + HEADER.pack(generation), 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def generation(self):
+        '''
+        Return the generation of the log (the number of checkpoints it has been through).
+        '''
+        fd = self._open()
+        return HEADER.unpack(os.pread(fd, HEADER.size, len(MAGIC)))[0]
+
+    def size(self):
+        '''
+        Return the size (in bytes) of the records of the log.
+        '''
+        return os.fstat(self._open()).st_size - RECORDS_START
+
+    def append(self, record, sync=True):
+        '''
+        Append a record (any picklable object) to the log and return once it is durable (fsynced).
+        The record is written with a single write, so the records of different processes are never mixed.
+
+        sync -> If False, return without waiting for the fsync (the record is made durable by the next one).
+                Only for records whose loss in a crash is harmless. Def: True
+        '''
+        data = pickle.dumps(record)
+        os.write(self._open(), RECORD.pack(len(data), zlib.crc32(data)) + data)
+        if not sync:
+            return
+        with self._sync_cond:
+            self._written += 1
+            written = self._written
+        self._sync(written)
+
+    def _sync(self, written):
+        '''
+        Return once the first written records (counted by append) are fsynced. If no fsync is running,
+        we lead one for every record written so far, else we wait for the running one (and lead the next
+        if it started before our record was written).
+        '''
+        with self._sync_cond:
+            while self._syncing and self._synced < written:
+                self._sync_cond.wait()
+            if self._synced >= written:
+                return
+            self._syncing = True
+        synced = self._synced
+        try:
+            if self.sync_interval:
+                time.sleep(self.sync_interval)
+            with self._sync_cond:
+                target = self._written
+            os.fsync(self._fd)
+            synced = target
+        finally:
+            # if the fsync failed, a waiter leads the next one
+            with self._sync_cond:
+                self._synced = max(self._synced, synced)
+                self._syncing = False
+                self._sync_cond.notify_all()
+
+    def sync(self):
+        '''
+        fsync the log now.
+        '''
+        if self._fd is not None:
+            os.fsync(self._fd)
+
+    def read(self, offset=0):
+        '''
+        Return the records of the log after offset (0 is the first record) and the offset after the last of them.
+        '''
+        fd = self._open()
+        start = RECORDS_START + offset
+        data = os.pread(fd, max(0, os.fstat(fd).st_size - start), start)
+        records = []
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            length, crc = RECORD.unpack_from(data, pos)
+            record = data[pos+RECORD.size:pos+RECORD.size+length]
+            if len(record) < length or zlib.crc32(record) != crc:
+                break
+            records.append(pickle.loads(record))
+            pos += RECORD.size + length
+        return records, offset + pos
+
+    def truncate(self):
+        '''
+        Remove every record and start the next generation of the log (at a checkpoint, once the tables are saved).
+        '''
+        generation = self.generation()
+        self.sync()
+        # the new generation is written first, the header stays valid whenever a crash happens
+        self._write_header(generation + 1)
+        os.ftruncate(self._fd, RECORDS_START)
+        os.fsync(self._fd)
+
+    def close(self):
+        self.sync()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None